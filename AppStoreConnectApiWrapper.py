@@ -1,85 +1,857 @@
+import base64
+import contextvars
+import fnmatch
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
 import time
-from authlib.jose import jwt
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from authlib.jose import JsonWebKey, jwt
 import requests
+import requests.adapters
+import urllib3.util.request
+from urllib.parse import urlsplit
 
-class AppStoreConnectApiWrapper:
+from AppStoreConnectInstrumentation import RequestEvent, current_span, endpoint_of, workflow_span
+from AppStoreConnectModels import Device, Profile
+from InventoryCache import InventoryCache
+
+logger = logging.getLogger(__name__)
+
+
+def _workflow(method):
     """
-    AppStoreConnectApiWrapper class provides methods to interact with the App Store Connect API.
+    Runs a workflow method inside a span named after it, so its RequestEvents can be grouped.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with workflow_span(method.__name__):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+class AppStoreConnectTokenManager:
+    """
+    AppStoreConnectTokenManager class signs and caches the JWT used as the App Store Connect bearer token.
+
+    The .p8 private key is read and parsed only once. The signed token is reused until it is about to expire,
+    then it is re-signed. All public methods are thread safe, so one instance can be shared between threads.
 
     Attributes:
-        EXPIRE_TIME: int - The expiration time of the JWT token.
-        ENDPOINT_DEVICES: str - The API endpoint for retrieving device information.
-        ENDPOINT_PROFILES: str - The API endpoint for retrieving profile information.
+        TOKEN_LIFETIME: float - Lifetime of a signed token in seconds. App Store Connect accepts at most 20 minutes.
+        REFRESH_MARGIN: float - A token is re-signed this many seconds before it expires.
 
     Methods:
         __init__(self, keyId: str, issuerId: str, p8FilePath: str)
-        get_device_list(self)
-        get_profile_list(self, filter_name: str = None)
-        get_profile_by_name(self, profile_name: str)
-        get_profile(self, provisioning_profile_id: str)
-        get_certificates_of_related_provisioning_profile(self, provisioning_profile_id: str)
-        get_bundle_id_of_related_provisioning_profile(self, provisioning_profile_id: str)
-        get_devices_of_related_provisioning_profile(self, provisioning_profile_id: str)
-        register_device(self, deviceName: str, deviceUdid: str, devicePlatform: str) -> bool
-        delete_profile(self, provisioning_profile_id: str)
-        duplicate_provisioning_profile"""
-    EXPIRE_TIME = int(round(time.time() + (20.0 * 60.0)))
-    ENDPOINT_DEVICES = "https://api.appstoreconnect.apple.com/v1/devices"
-    ENDPOINT_PROFILES = "https://api.appstoreconnect.apple.com/v1/profiles"
+        keyId(self) -> str
+        issuerId(self) -> str
+        get_authorization_header(self) -> dict
+        invalidate(self)"""
+    TOKEN_LIFETIME = 20.0 * 60.0
+    REFRESH_MARGIN = 60.0
 
     def __init__(self, keyId: str, issuerId: str, p8FilePath: str):
-        self.__header = {}
-        self.__payload = {}
-        self.__private_key = None
         self.__keyId = keyId
         self.__issuerId = issuerId
         self.__p8FilePath = p8FilePath
+        self.__private_key = None
+        self.__authorization = None
+        self.__expire_time = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def keyId(self) -> str:
+        return self.__keyId
+
+    @property
+    def issuerId(self) -> str:
+        return self.__issuerId
+
+    def __load_private_key(self):
+        with open(self.__p8FilePath, "rb") as file:
+            pem = file.read()
+        return JsonWebKey.import_key(pem, {"kty": "EC"})
 
-    def __update_header(self):
-        self.__header = {
+    def __sign(self, now: float):
+        if self.__private_key is None:
+            self.__private_key = self.__load_private_key()
+
+        expire_time = now + self.TOKEN_LIFETIME
+        header = {
             "alg": "ES256",
             "kid": self.__keyId,
             "type": "JWT"
         }
-
-        self.__payload = {
+        payload = {
             "iss": self.__issuerId,
-            "exp": self.EXPIRE_TIME,
+            "iat": int(now),
+            "exp": int(expire_time),
             "aud": "appstoreconnect-v1"
         }
-        with open(self.__p8FilePath, "r") as file:
-            private_key = file.read()
+        token = jwt.encode(header, payload, self.__private_key)
+        self.__authorization = "Bearer " + token.decode()
+        self.__expire_time = expire_time
+
+    def get_authorization_header(self) -> dict:
+        """
+        Returns the Authorization header for an App Store Connect request.
+
+        The cached token is returned while it is valid for more than REFRESH_MARGIN seconds,
+        otherwise a new token is signed first.
+
+        :return: A dict like {"Authorization": "Bearer ..."}.
+        :rtype: dict
+        """
+        now = time.time()
+        with self.__lock:
+            if self.__authorization is None or now >= self.__expire_time - self.REFRESH_MARGIN:
+                self.__sign(now)
+            return {"Authorization": self.__authorization}
+
+    def invalidate(self):
+        """
+        Drops the cached token so that the next call signs a new one. The parsed key is kept.
+        """
+        with self.__lock:
+            self.__authorization = None
+            self.__expire_time = 0.0
+
+
+class AppStoreConnectRequestScheduler:
+    """
+    AppStoreConnectRequestScheduler class paces and retries the requests sent to App Store Connect.
+
+    Until the server has reported its quota, requests take a token from a token bucket of burst tokens that
+    refills at the hourly limit of the API key. The X-Rate-Limit header of every response
+    (e.g. "user-hour-lim:3600;user-hour-rem:3412;") then updates the limit and the remaining quota, and the
+    remaining quota becomes the bucket: requests are sent as fast as the callers issue them while quota is left,
+    and are only paced at the hourly rate once it is used up. The quota is treated as a sliding window, so it
+    refills at the hourly rate as well. 429 and 5xx responses and connection errors are retried
+    with jittered exponential backoff, honoring Retry-After. Only 429 responses are retried for
+    non-idempotent methods, since the server did not process them.
+
+    One scheduler can be shared by several wrappers and threads using the same API key.
+
+    Attributes:
+        RETRY_STATUS_CODES: tuple - Status codes that are retried.
+        IDEMPOTENT_METHODS: tuple - Methods that are also retried on 5xx responses and connection errors.
+
+    Methods:
+        __init__(self, hourly_limit: int = 3600, burst: int = 50, max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0)
+        execute(self, method: str, send) -> requests.Response
+        budget(self) -> dict"""
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+    def __init__(self, hourly_limit: int = 3600, burst: int = 50, max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0):
+        """
+        :param hourly_limit: Requests per hour assumed until the server reports its limit.
+        :param burst: Maximum number of requests sent back to back before the server has reported its quota.
+        :param max_retries: Maximum number of retries of one request.
+        :param backoff_base: Upper bound of the first backoff delay in seconds. It doubles on each retry.
+        :param backoff_max: Upper bound of any backoff delay in seconds.
+        """
+        self.__condition = threading.Condition()
+        self.__hourly_limit = hourly_limit
+        self.__remaining = None
+        self.__burst = burst
+        self.__tokens = float(burst)
+        self.__updated_at = time.monotonic()
+        self.__paused_until = 0.0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def __refill(self, now: float):
+        # the hourly quota is treated as a sliding window, so the reported remaining quota also refills
+        refilled = (now - self.__updated_at) * self.__hourly_limit / 3600.0
+        self.__tokens = min(float(self.__burst), self.__tokens + refilled)
+        if self.__remaining is not None:
+            # the reported quota is the bucket, so callers are not held back while the server has quota left
+            self.__remaining = min(float(self.__hourly_limit), self.__remaining + refilled)
+            self.__tokens = self.__remaining
+        self.__updated_at = now
+
+    def __acquire(self):
+        with self.__condition:
+            while True:
+                now = time.monotonic()
+                self.__refill(now)
+                if now < self.__paused_until:
+                    wait = self.__paused_until - now
+                elif self.__tokens >= 1.0:
+                    self.__tokens -= 1.0
+                    if self.__remaining is not None:
+                        self.__remaining -= 1.0
+                    return
+                else:
+                    wait = (1.0 - self.__tokens) * 3600.0 / max(self.__hourly_limit, 1)
+                self.__condition.wait(wait)
+
+    def __update(self, response: requests.Response):
+        values = {}
+        for item in response.headers.get("X-Rate-Limit", "").split(";"):
+            key, _, value = item.partition(":")
+            if value.strip().isdigit():
+                values[key.strip()] = int(value)
+        with self.__condition:
+            if "user-hour-lim" in values:
+                self.__hourly_limit = values["user-hour-lim"]
+            if "user-hour-rem" in values:
+                self.__remaining = float(values["user-hour-rem"])
+                self.__tokens = self.__remaining
+            if response.status_code == 429:
+                self.__tokens = 0.0
+                if self.__remaining is not None:
+                    self.__remaining = 0.0
+            self.__condition.notify_all()
+
+    def __pause(self, delay: float):
+        with self.__condition:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + delay)
+
+    def __backoff(self, attempt: int, response: requests.Response = None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.strip().isdigit():
+            return float(retry_after)
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def execute(self, method: str, send) -> requests.Response:
+        """
+        Sends a request through the token bucket and retries it when needed.
+
+        :param method: The HTTP method, used to decide which failures are retried.
+        :param send: A callable without arguments that sends the request and returns the requests.Response.
+        :return: The last response. Its retries attribute holds the number of retries.
+        :raises requests.exceptions.RequestException: If the request still fails after max_retries retries.
+        """
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self.__acquire()
+            try:
+                response = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                time.sleep(self.__backoff(attempt))
+                attempt += 1
+                continue
+
+            self.__update(response)
+            retryable = response.status_code == 429 or (idempotent and response.status_code in self.RETRY_STATUS_CODES)
+            if not retryable or attempt >= self.max_retries:
+                response.retries = attempt
+                return response
+
+            delay = self.__backoff(attempt, response)
+            if response.status_code == 429:
+                # every thread sharing the scheduler waits, not only this one
+                self.__pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    def budget(self) -> dict:
+        """
+        :return: The current rate limit state, like {"hourly_limit": 3600, "remaining": 3412, "tokens": 49.0}.
+                 remaining is None until the server has reported it.
+        """
+        with self.__condition:
+            self.__refill(time.monotonic())
+            remaining = None if self.__remaining is None else int(self.__remaining)
+            return {"hourly_limit": self.__hourly_limit, "remaining": remaining, "tokens": self.__tokens}
+
+
+class RequestMemoizer:
+    """
+    RequestMemoizer class memoizes successful GET responses for a short time and coalesces identical GET requests
+    that are in flight at the same time into one network call.
+
+    At most max_entries responses are kept, evicting the least recently used one. clear() drops every entry,
+    detaches the requests already in flight so later callers send a fresh request instead of joining them, and
+    prevents those requests from storing their responses, so it is called after every mutating request.
+
+    Methods:
+        __init__(self, ttl: float = 5.0, max_entries: int = 256)
+        get(self, key, fetch) -> requests.Response
+        clear(self)"""
+
+    def __init__(self, ttl: float = 5.0, max_entries: int = 256):
+        """
+        :param ttl: Number of seconds a response is reused. 0 disables the memoization but keeps the coalescing.
+        :param max_entries: Maximum number of responses kept.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__in_flight = {}
+        self.__generation = 0
+
+    def get(self, key, fetch) -> requests.Response:
+        """
+        Returns the memoized response of key, the response of an identical request in flight, or the result of fetch.
+
+        :param key: A hashable key identifying the request.
+        :param fetch: A callable without arguments that sends the request and returns the requests.Response.
+        :return: The response. It may be shared with other callers, so it must not be modified.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if time.monotonic() < entry[0]:
+                    self.__entries.move_to_end(key)
+                    return entry[1]
+                del self.__entries[key]
+            future = self.__in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.__in_flight[key] = future
+                generation = self.__generation
+        if not owner:
+            return future.result()
+
+        try:
+            response = fetch()
+        except BaseException as e:
+            with self.__lock:
+                self.__release(key, future)
+            future.set_exception(e)
+            raise
+        with self.__lock:
+            self.__release(key, future)
+            if response.ok and self.ttl > 0 and generation == self.__generation:
+                self.__entries[key] = (time.monotonic() + self.ttl, response)
+                self.__entries.move_to_end(key)
+                while len(self.__entries) > self.max_entries:
+                    self.__entries.popitem(last=False)
+        future.set_result(response)
+        return response
+
+    def __release(self, key, future: Future):
+        # clear() may have detached this request and a newer one may own the key by now
+        if self.__in_flight.get(key) is future:
+            del self.__in_flight[key]
+
+    def clear(self):
+        """
+        Drops every memoized response and detaches the requests in flight.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.__in_flight.clear()
+            self.__generation += 1
+
+
+class ProfileIndex:
+    """
+    ProfileIndex class indexes profile resources already in memory by name, profileType, profileState
+    and related bundle ID, so lookups only touch the matching profiles.
+
+    The bundle ID key is only available for profiles fetched with their bundleId relationship.
+
+    Methods:
+        __init__(self, profiles: list)
+        find(self, name: str = None, profile_type: str = None, state: str = None, bundle_id: str = None) -> list"""
+
+    def __init__(self, profiles: list):
+        self.__profiles = list(profiles)
+        self.__keys = {"name": {}, "profileType": {}, "profileState": {}, "bundleId": {}}
+        for position, profile in enumerate(self.__profiles):
+            attributes = profile.get("attributes", {})
+            bundle_id = (profile.get("relationships", {}).get("bundleId", {}).get("data") or {}).get("id")
+            values = {
+                "name": attributes.get("name"),
+                "profileType": attributes.get("profileType"),
+                "profileState": attributes.get("profileState"),
+                "bundleId": bundle_id
+            }
+            for key, value in values.items():
+                if value is not None:
+                    self.__keys[key].setdefault(value, []).append(position)
+
+    def __len__(self):
+        return len(self.__profiles)
+
+    def find(self, name: str = None, profile_type: str = None, state: str = None, bundle_id: str = None) -> list:
+        """
+        :return: The profiles matching every given condition, in their original order.
+        """
+        conditions = {"name": name, "profileType": profile_type, "profileState": state, "bundleId": bundle_id}
+        matched = None
+        for key, value in conditions.items():
+            if value is None:
+                continue
+            positions = self.__keys[key].get(value, [])
+            matched = set(positions) if matched is None else matched.intersection(positions)
+            if not matched:
+                return []
+        if matched is None:
+            return list(self.__profiles)
+        return [self.__profiles[position] for position in sorted(matched)]
+
+
+class AppStoreConnectApiWrapper:
+    """
+    AppStoreConnectApiWrapper class provides methods to interact with the App Store Connect API.
+
+    Attributes:
+        BASE_URL_ENVIRONMENT_VARIABLE: str - Environment variable overriding the API base URL with a loopback
+                                             address, e.g. for a local FakeAppStoreConnectServer. Other hosts are
+                                             ignored so the environment cannot redirect the signed requests.
+        LOOPBACK_HOSTS: tuple - The hosts BASE_URL_ENVIRONMENT_VARIABLE may point to.
+        ENDPOINT_DEVICES: str - The API endpoint for retrieving device information.
+        ENDPOINT_PROFILES: str - The API endpoint for retrieving profile information.
+        ENDPOINT_BUNDLE_IDS: str - The API endpoint for retrieving bundle ID information.
+
+    Methods:
+        __init__(self, keyId: str, issuerId: str, p8FilePath: str, token_manager: AppStoreConnectTokenManager = None,
+                 session: requests.Session = None, pool_connections: int = 4, pool_maxsize: int = 16,
+                 timeout: float = 60.0, cache: InventoryCache = None,
+                 scheduler: AppStoreConnectRequestScheduler = None, memoizer: RequestMemoizer = None,
+                 base_url: str = None, journal_dir: str = None)
+        rate_limit_budget(self) -> dict
+        add_observer(self, observer)
+        remove_observer(self, observer)
+        span(name: str)
+        refresh_inventory(self, force: bool = False) -> bool
+        get_device_list(self, fields: dict = None)
+        get_profile_list(self, filter_name: str = None, fields: dict = None)
+        get_devices(self, fields: dict = None)
+        get_profiles(self, name: str = None, profile_type: str = None, state: str = None, fields: dict = None)
+        iter_devices(self, params: dict = None, fields: dict = None)
+        iter_profiles(self, params: dict = None, fields: dict = None)
+        fields_params(fields: dict) -> dict
+        get_profile_by_name(self, profile_name: str, fields: dict = None)
+        find_profiles(self, name: str = None, profile_type: str = None, state: str = None, bundle_id: str = None,
+                      bundle_identifier: str = None, profiles=None, fields: dict = None)
+        get_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_certificates_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_bundle_id_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_devices_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_profile_with_relationships(self, provisioning_profile_id: str, fields: dict = None)
+        register_device(self, deviceName: str, deviceUdid: str, devicePlatform: str) -> bool
+        register_devices(self, devices, max_workers: int = 4, dry_run: bool = False)
+        delete_profile(self, provisioning_profile_id: str)
+        create_profile(self, name: str, profile_type: str, bundle_id: str, device_ids: list, certificate_ids: list)
+        duplicate_provisioning_profile(self, provisioning_profile_id: str, duplicate_name: str, profile_graph: dict = None)
+        update_provisioning_profile_all_devices(self, provisioning_profile_name: str)
+        update_provisioning_profiles_all_devices(self, profile_names: list = None, name_pattern: str = None,
+                                                 max_workers: int = 4, force: bool = False)
+        download_profiles(self, output_dir: str, name: str = None, profile_type: str = None, bundle_id: str = None,
+                          bundle_identifier: str = None, name_pattern: str = None, max_workers: int = 4)
+        close(self)
+
+    The wrapper owns a pooled requests.Session, so every call reuses kept-alive connections to the API.
+    Use it as a context manager, or call close(), to release the connections:
+
+        with AppStoreConnectApiWrapper(keyId, issuerId, p8FilePath) as api:
+            api.get_device_list()
+
+    Errors are reported through the "AppStoreConnectApiWrapper" logger, and every request sent to the API is
+    reported to the observers as a RequestEvent:
+
+        metrics = MetricsRegistry()
+        api.add_observer(metrics)
+        api.add_observer(LoggingSink())"""
+    BASE_URL_ENVIRONMENT_VARIABLE = "APP_STORE_CONNECT_API_BASE_URL"
+    LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+    ENDPOINT_DEVICES = "https://api.appstoreconnect.apple.com/v1/devices"
+    ENDPOINT_PROFILES = "https://api.appstoreconnect.apple.com/v1/profiles"
+    ENDPOINT_BUNDLE_IDS = "https://api.appstoreconnect.apple.com/v1/bundleIds"
+    MAX_PAGE_SIZE = 200
+    INCLUDE_LIMIT = 50
+    PROFILE_MANIFEST_FILE_NAME = ".profiles_manifest.json"
+    PROFILE_METADATA_FIELDS = {"profiles": ("name", "profileType", "profileState", "platform", "uuid",
+                                            "expirationDate")}
+    PROFILE_RELATIONSHIP_FIELDS = {"profiles": ("name", "profileType", "profileState", "bundleId", "certificates",
+                                                "devices"),
+                                   "bundleIds": ("name", "identifier", "platform"),
+                                   "certificates": ("name", "certificateType", "serialNumber", "expirationDate"),
+                                   "devices": ("name", "udid", "platform", "status")}
+    DEVICE_METADATA_FIELDS = {"devices": ("name", "udid", "platform", "status")}
+
+    def __init__(self, keyId: str, issuerId: str, p8FilePath: str, token_manager: AppStoreConnectTokenManager = None,
+                 session: requests.Session = None, pool_connections: int = 4, pool_maxsize: int = 16,
+                 timeout: float = 60.0, cache: InventoryCache = None,
+                 scheduler: AppStoreConnectRequestScheduler = None, memoizer: RequestMemoizer = None,
+                 base_url: str = None, journal_dir: str = None):
+        """
+        :param keyId: The key id of the App Store Connect API key.
+        :param issuerId: The issuer id of the App Store Connect API key.
+        :param p8FilePath: Path to the .p8 private key file.
+        :param token_manager: An existing token manager to share between clients. A new one is created if None.
+        :param session: A caller supplied session. It is used as is and is not closed by close().
+        :param pool_connections: Number of host pools kept by the owned session.
+        :param pool_maxsize: Maximum number of kept-alive connections per host. Should be at least the number of
+                             threads calling the wrapper concurrently.
+        :param timeout: Timeout in seconds for connecting and reading each request. None waits forever.
+        :param cache: An optional local inventory cache. Device and profile reads are served from it while it is
+                      fresh, and it is updated by the results of every request.
+        :param scheduler: The scheduler pacing and retrying the requests. Share one between the wrappers using the
+                          same API key so they respect the same rate limit. A new one is created if None.
+        :param memoizer: The memoizer of GET responses. It is cleared after every POST, PATCH or DELETE request.
+                         A new one with a 5 second TTL is created if None.
+        :param base_url: The scheme and host of the API, e.g. "http://127.0.0.1:8080". Defaults to the
+                         BASE_URL_ENVIRONMENT_VARIABLE environment variable if it points to a loopback address,
+                         then to the App Store Connect API.
+        :param journal_dir: Directory of the journal of refresh_planner, which every profile refresh goes through.
+                            Defaults to ProfileRefreshPlanner.DEFAULT_JOURNAL_DIR.
+        """
+        base_url = base_url or self.__environment_base_url()
+        if base_url:
+            base_url = base_url.rstrip("/")
+            self.ENDPOINT_DEVICES = f"{base_url}/v1/devices"
+            self.ENDPOINT_PROFILES = f"{base_url}/v1/profiles"
+            self.ENDPOINT_BUNDLE_IDS = f"{base_url}/v1/bundleIds"
+        if token_manager is None:
+            token_manager = AppStoreConnectTokenManager(keyId, issuerId, p8FilePath)
+        self.__token_manager = token_manager
+        self.__timeout = timeout
+        self.__owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Connection"] = "keep-alive"
+        self.__session = session
+        self.__prefetch_executor = None
+        self.__prefetch_lock = threading.Lock()
+        self.__cache = cache
+        if scheduler is None:
+            scheduler = AppStoreConnectRequestScheduler()
+        self.__scheduler = scheduler
+        if memoizer is None:
+            memoizer = RequestMemoizer()
+        self.__memoizer = memoizer
+        self.__observers = ()
+        self.__observers_lock = threading.Lock()
+        # imported here because ProfileRefreshPlanner imports this module
+        from ProfileRefreshPlanner import ProfileRefreshPlanner
+        self.__refresh_planner = ProfileRefreshPlanner(self, journal_dir)
+
+    @property
+    def cache(self) -> InventoryCache:
+        return self.__cache
+
+    @property
+    def token_manager(self) -> AppStoreConnectTokenManager:
+        return self.__token_manager
+
+    @property
+    def scheduler(self) -> AppStoreConnectRequestScheduler:
+        return self.__scheduler
+
+    @property
+    def memoizer(self) -> RequestMemoizer:
+        return self.__memoizer
+
+    @property
+    def refresh_planner(self):
+        """
+        :return: The ProfileRefreshPlanner used by the profile refresh methods.
+        """
+        return self.__refresh_planner
+
+    def rate_limit_budget(self) -> dict:
+        """
+        :return: The current rate limit state of the scheduler. See AppStoreConnectRequestScheduler.budget.
+        """
+        return self.__scheduler.budget()
+
+    @property
+    def session(self) -> requests.Session:
+        return self.__session
+
+    def close(self):
+        """
+        Closes the pooled connections. A session supplied by the caller is left open.
+        """
+        with self.__prefetch_lock:
+            if self.__prefetch_executor is not None:
+                self.__prefetch_executor.shutdown(wait=True, cancel_futures=True)
+                self.__prefetch_executor = None
+        if self.__owns_session:
+            self.__session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_observer(self, observer):
+        """
+        Registers a callable receiving a RequestEvent after every request sent to the API, e.g. a LoggingSink or
+        a MetricsRegistry of AppStoreConnectInstrumentation. Observers are called on the thread that sent the
+        request, so they must be thread safe and fast. Exceptions raised by observers are logged and ignored.
+        Memoized GET responses are not sent again and do not produce events.
+        """
+        with self.__observers_lock:
+            self.__observers = self.__observers + (observer,)
+
+    def remove_observer(self, observer):
+        with self.__observers_lock:
+            self.__observers = tuple(registered for registered in self.__observers if registered is not observer)
+
+    @staticmethod
+    def span(name: str):
+        """
+        Groups the requests sent inside the with block, including those sent by worker threads of the wrapper,
+        under one span id in their RequestEvents. The workflows of the wrapper open their own span.
+
+            with api.span("nightly_refresh"):
+                api.update_provisioning_profiles_all_devices(name_pattern="Nightly *")
+        """
+        return workflow_span(name)
+
+    @staticmethod
+    def __submit(executor: ThreadPoolExecutor, function, *args) -> Future:
+        # runs the function in a copy of the caller's context, so the worker's requests keep the caller's span
+        return executor.submit(contextvars.copy_context().run, function, *args)
+
+    def __map(self, executor: ThreadPoolExecutor, function, iterable):
+        futures = [self.__submit(executor, function, item) for item in iterable]
+        return (future.result() for future in futures)
+
+    def __notify(self, event: RequestEvent):
+        for observer in self.__observers:
+            try:
+                observer(event)
+            except Exception:
+                logger.exception("request observer %r failed", observer)
+
+    def __execute(self, method: str, url: str, send) -> requests.Response:
+        """
+        Sends a request through the scheduler, logs failed responses and reports the request to the observers.
+        """
+        started = time.monotonic()
+        response = None
+        error = None
+        try:
+            response = self.__scheduler.execute(method, send)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if response is not None and not response.ok:
+                logger.error("%s %s failed with %d: %s", method, url, response.status_code, response.text)
+            if self.__observers:
+                span_id, span_name = current_span()
+                self.__notify(RequestEvent(
+                    method, endpoint_of(urlsplit(url).path), url,
+                    response.status_code if response is not None else None, time.monotonic() - started,
+                    len(response.content) if response is not None else 0,
+                    getattr(response, "retries", 0), self.__scheduler.budget().get("remaining"),
+                    span_id, span_name, repr(error) if error is not None else None))
+
+    def __request(self, method: str, url: str, **kwargs) -> requests.Response:
+        extra_headers = kwargs.pop("headers", None) or {}
+        kwargs.setdefault("timeout", self.__timeout)
+
+        def send():
+            # the token is read on every attempt, since a retry may wait until it has expired
+            headers = {"Accept-Encoding": urllib3.util.request.ACCEPT_ENCODING}
+            headers.update(extra_headers)
+            headers.update(self.__token_manager.get_authorization_header())
+            return self.__session.request(method, url, headers=headers, **kwargs)
+
+        if method != "GET":
+            try:
+                return self.__execute(method, url, send)
+            finally:
+                self.__memoizer.clear()
+
+        params = kwargs.get("params") or {}
+        key = (url, tuple(sorted((name, str(value)) for name, value in params.items())),
+               tuple(sorted(extra_headers.items())))
+        return self.__memoizer.get(key, lambda: self.__execute(method, url, send))
+
+    def __get_page(self, url: str, params: dict = None) -> dict:
+        response = self.__request("GET", url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def __get_prefetch_executor(self) -> ThreadPoolExecutor:
+        with self.__prefetch_lock:
+            if self.__prefetch_executor is None:
+                self.__prefetch_executor = ThreadPoolExecutor(thread_name_prefix="AppStoreConnectPrefetch")
+            return self.__prefetch_executor
+
+    def __iter_pages(self, url: str, params: dict = None):
+        """
+        Yields every page of a cursor paginated collection by following links.next.
+        The next page is requested in the background while the caller processes the current one.
+        """
+        executor = self.__get_prefetch_executor()
+        future = self.__submit(executor, self.__get_page, url, params)
+        try:
+            while future is not None:
+                page = future.result()
+                next_url = page.get("links", {}).get("next")
+                future = self.__submit(executor, self.__get_page, next_url) if next_url else None
+                yield page
+        finally:
+            if future is not None:
+                future.cancel()
+
+    @staticmethod
+    def fields_params(fields: dict) -> dict:
+        """
+        Converts a sparse fieldset selection into query parameters.
+
+        :param fields: A dict mapping resource types to the attribute and relationship names to return,
+                       e.g. {"profiles": ["name", "profileType"]}. None returns every field.
+        :return: The query parameters, e.g. {"fields[profiles]": "name,profileType"}.
+        """
+        return {f"fields[{resource_type}]": ",".join(names) for resource_type, names in (fields or {}).items()}
+
+    @classmethod
+    def __environment_base_url(cls):
+        base_url = os.environ.get(cls.BASE_URL_ENVIRONMENT_VARIABLE)
+        if not base_url:
+            return None
+        if urlsplit(base_url).hostname not in cls.LOOPBACK_HOSTS:
+            logger.warning("Ignoring %s=%s: only loopback addresses are allowed", cls.BASE_URL_ENVIRONMENT_VARIABLE,
+                           base_url)
+            return None
+        return base_url
+
+    @staticmethod
+    def __type_fields(fields: dict, resource_type: str):
+        # the fields of one resource type in a sparse fieldset selection, or None if every field is returned
+        return None if fields is None or resource_type not in fields else tuple(fields[resource_type])
+
+    def __iter_resources(self, url: str, params: dict = None, fields: dict = None):
+        params = dict(params or {})
+        params.update(self.fields_params(fields))
+        params.setdefault("limit", self.MAX_PAGE_SIZE)
+        for page in self.__iter_pages(url, params):
+            yield from page["data"]
+
+    def __collect_list(self, resources) -> dict:
+        data = list(resources)
+        return {"data": data, "meta": {"paging": {"total": len(data)}}}
+
+    def iter_devices(self, params: dict = None, fields: dict = None):
+        """
+        Lazily iterates over every registered device, following the pagination cursor.
+
+        Pages are requested with the maximum page size, and the next page is prefetched
+        while the caller consumes the current one.
+
+        :param params: Extra query parameters such as {"filter[platform]": "IOS"}.
+        :param fields: Sparse fieldsets, e.g. DEVICE_METADATA_FIELDS. See fields_params.
+        :return: A generator of device resource objects.
+        :raises requests.exceptions.RequestException: If a page could not be retrieved.
+        """
+        return self.__iter_resources(self.ENDPOINT_DEVICES, params, fields)
+
+    def iter_profiles(self, params: dict = None, fields: dict = None):
+        """
+        Lazily iterates over every provisioning profile, following the pagination cursor.
 
-        token = jwt.encode(self.__header, self.__payload, private_key)
-        auth_jwt = "Bearer " + token.decode()
-        self.__header = {"Authorization": auth_jwt}
+        Pages are requested with the maximum page size, and the next page is prefetched
+        while the caller consumes the current one.
 
-    def get_device_list(self):
+        :param params: Extra query parameters such as {"filter[name]": "MyProfile"}.
+        :param fields: Sparse fieldsets, e.g. PROFILE_METADATA_FIELDS to leave out profileContent. See fields_params.
+        :return: A generator of profile resource objects.
+        :raises requests.exceptions.RequestException: If a page could not be retrieved.
         """
-        Retrieves the device list from the endpoint.
+        return self.__iter_resources(self.ENDPOINT_PROFILES, params, fields)
+
+    def refresh_inventory(self, force: bool = False) -> bool:
+        """
+        Syncs the devices and profiles of the inventory cache with the API.
+
+        :param force: Sync even the resource types that are still fresh.
+        :return: True if the cache is fresh afterwards, False if there is no cache or a sync failed.
+        """
+        if self.__cache is None:
+            return False
+        if force:
+            self.__cache.invalidate()
+        return self.get_device_list() is not None and self.get_profile_list() is not None
+
+    def get_device_list(self, fields: dict = None):
+        """
+        Retrieves the device list from the endpoint. All pages are fetched.
+        The list is served from the inventory cache while it is fresh.
+        :param fields: Sparse fieldsets, e.g. DEVICE_METADATA_FIELDS. See fields_params.
         :return: the device list as a JSON object, or None if there's an error
         """
+        if self.__cache is not None and self.__cache.is_fresh("devices", self.__type_fields(fields, "devices")):
+            return self.__collect_list(self.__cache.list("devices"))
         try:
-            self.__update_header()
-            response = requests.get(f"{self.ENDPOINT_DEVICES}?limit=200", headers=self.__header)
-            if not response.ok:
-                print(response.text)
-                return None
-            return response.json()
-        except requests.exceptions as e:
-            print(e)
+            devices = self.__collect_list(self.iter_devices(fields=fields))
+            if self.__cache is not None:
+                self.__cache.replace_all("devices", devices["data"], self.__type_fields(fields, "devices"))
+            return devices
+        except requests.exceptions.RequestException as e:
+            logger.error("%s", e)
+            return None
+
+    def get_devices(self, fields: dict = None):
+        """
+        Retrieves every device as a Device model.
+        The pages are converted while they are streamed, so the raw responses are not kept.
+
+        :param fields: Sparse fieldsets, e.g. DEVICE_METADATA_FIELDS. See fields_params.
+        :return: A list of Device, or None if there's an error.
+        :rtype: list or None
+        """
+        if self.__cache is not None and self.__cache.is_fresh("devices", self.__type_fields(fields, "devices")):
+            return [Device.from_resource(device) for device in self.__cache.list("devices")]
+        try:
+            return [Device.from_resource(device) for device in self.iter_devices(fields=fields)]
+        except requests.exceptions.RequestException as e:
+            logger.error("%s", e)
             return None
 
-    def get_profile_list(self, filter_name: str = None):
+    def get_profiles(self, name: str = None, profile_type: str = None, state: str = None, fields: dict = None):
+        """
+        Retrieves the matching profiles as Profile models. The conditions are sent as server side filters.
+        The profile content stays base64 encoded until Profile.content is read.
+
+        :param name: The exact profile name.
+        :param profile_type: The profileType, e.g. IOS_APP_DEVELOPMENT.
+        :param state: The profileState, e.g. ACTIVE.
+        :param fields: Sparse fieldsets, e.g. PROFILE_METADATA_FIELDS. See fields_params.
+        :return: A list of Profile, or None if there's an error.
+        :rtype: list or None
+        """
+        conditions = {"name": name, "profileType": profile_type, "profileState": state}
+        params = {f"filter[{key}]": value for key, value in conditions.items() if value is not None}
+        try:
+            return [Profile.from_resource(profile) for profile in self.iter_profiles(params, fields)]
+        except requests.exceptions.RequestException as e:
+            logger.error("%s", e)
+            return None
+
+    def get_profile_list(self, filter_name: str = None, fields: dict = None):
         """
         :param filter_name: The name to filter the profiles by. Default is None.
+        :param fields: Sparse fieldsets, e.g. PROFILE_METADATA_FIELDS to leave out profileContent. See fields_params.
         :return: The JSON response containing the profile list, or None if there was an error.
 
-        This method is used to get a list of profiles. It sends a GET request to the profiles endpoint
-        with an optional filter name parameter. If the filter name is provided, it adds the filter to the
+        This method is used to get a list of profiles. It sends GET requests to the profiles endpoint
+        with an optional filter name parameter, following the pagination until every page is fetched. If the filter name is provided, it adds the filter to the
         request parameters. It then checks the response status and returns the JSON response if successful,
-        or None if there was an error. If there is an exception during the request, it prints the error and
-        returns None.
+        or None if there was an error. If there is an exception during the request, it logs the error and
+        returns None. While the inventory cache is fresh, the profiles are read from it instead.
 
         Example usage:
             get_profile_list() -> '{"profiles": [...]}'  # Return JSON response with the list of profiles
@@ -87,102 +859,160 @@ class AppStoreConnectApiWrapper:
             get_profile_list("NonExisting") -> None  # Return None when no profiles match the filter
             get_profile_list("InvalidName") -> None  # Return None when there was an error during the request
         """
-        try:
-            self.__update_header()
+        profile_fields = self.__type_fields(fields, "profiles")
+        if self.__cache is not None and self.__cache.is_fresh("profiles", profile_fields):
             if filter_name is None:
-                response = requests.get(self.ENDPOINT_PROFILES, headers=self.__header)
-            else:
-                response = requests.get(self.ENDPOINT_PROFILES, params={"filter[name]": filter_name}, headers=self.__header)
-
-            if not response.ok:
-                print(response.text)
-                return None
-            return response.json()
+                return self.__collect_list(self.__cache.list("profiles"))
+            return self.__collect_list(self.__cache.find_by_name("profiles", filter_name))
+        try:
+            params = None if filter_name is None else {"filter[name]": filter_name}
+            profiles = self.__collect_list(self.iter_profiles(params, fields))
+            if self.__cache is not None:
+                if filter_name is None:
+                    self.__cache.replace_all("profiles", profiles["data"], profile_fields)
+                else:
+                    for profile in profiles["data"]:
+                        self.__cache.upsert(profile, partial=profile_fields is not None)
+            return profiles
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return None
 
-    def get_profile_by_name(self, profile_name: str):
+    def get_profile_by_name(self, profile_name: str, fields: dict = None):
         """
         Retrieves a profile by its name.
 
         :param profile_name: The name of the profile to retrieve.
         :type profile_name: str
+        :param fields: Sparse fieldsets, e.g. PROFILE_METADATA_FIELDS to skip the profileContent. See fields_params.
         :return: The profile object matching the specified name. None if the profile could not be found.
         :rtype: dict or None
         """
-        profiles = self.get_profile_list()
+        profiles = self.find_profiles(name=profile_name, fields=fields)
         if profiles is None:
-            print("Profile取得に失敗しました")
+            logger.error("Profile取得に失敗しました")
+            return None
+
+        return profiles[0] if profiles else None
+
+    def find_profiles(self, name: str = None, profile_type: str = None, state: str = None, bundle_id: str = None,
+                      bundle_identifier: str = None, profiles=None, fields: dict = None):
+        """
+        Finds the profiles matching every given condition.
+
+        The conditions are sent to the API as filter[...] parameters, so only the matching profiles are
+        downloaded. A bundle ID condition is resolved through the profiles relationship of the bundle ID.
+        When the profiles are already in memory, pass them as profiles and the lookup is done on a
+        ProfileIndex without any request. A fresh inventory cache is used the same way.
+
+        :param name: The exact profile name.
+        :param profile_type: The profileType, e.g. IOS_APP_DEVELOPMENT.
+        :param state: The profileState, e.g. ACTIVE or INVALID.
+        :param bundle_id: The resource id of the related bundle ID.
+        :param bundle_identifier: The identifier of the related bundle ID, e.g. com.example.app.
+        :param profiles: A ProfileIndex or a list of profile resources to search instead of the API.
+        :param fields: Sparse fieldsets, e.g. PROFILE_METADATA_FIELDS to leave out profileContent. See fields_params.
+                       The attributes used as conditions are always requested.
+        :return: A list of matching profile resources, or None if there was an error.
+        :rtype: list or None
+        """
+        conditions = {"name": name, "profileType": profile_type, "profileState": state}
+        if profiles is not None and bundle_identifier is None:
+            index = profiles if isinstance(profiles, ProfileIndex) else ProfileIndex(profiles)
+            return index.find(name, profile_type, state, bundle_id)
+        if fields is not None and "profiles" in fields:
+            fields = dict(fields)
+            fields["profiles"] = tuple(fields["profiles"]) + tuple(
+                key for key, value in conditions.items() if value is not None and key not in fields["profiles"])
+        if self.__cache is not None and self.__cache.is_fresh("profiles", self.__type_fields(fields, "profiles")) \
+                and name is not None and bundle_id is None and bundle_identifier is None:
+            return ProfileIndex(self.__cache.find_by_name("profiles", name)).find(name, profile_type, state)
+
+        try:
+            if bundle_id is None and bundle_identifier is None:
+                params = {f"filter[{key}]": value for key, value in conditions.items() if value is not None}
+                found = list(self.iter_profiles(params, fields))
+            else:
+                bundle_ids = [bundle_id] if bundle_id is not None else [
+                    resource["id"] for resource in self.__iter_resources(
+                        self.ENDPOINT_BUNDLE_IDS, {"filter[identifier]": bundle_identifier})
+                    if resource["attributes"]["identifier"] == bundle_identifier]
+                found = []
+                for resource_id in bundle_ids:
+                    found.extend(self.__iter_resources(f"{self.ENDPOINT_BUNDLE_IDS}/{resource_id}/profiles",
+                                                       fields=fields))
+        except requests.exceptions.RequestException as e:
+            logger.error("%s", e)
             return None
 
-        for profile in profiles["data"]:
-            if profile["attributes"]["name"] == profile_name:
-                return profile
-        return None
+        # the API matches some filters loosely, so the result is checked again here
+        return ProfileIndex(found).find(name, profile_type, state)
 
-    def get_profile(self, provisioning_profile_id: str):
+    def get_profile(self, provisioning_profile_id: str, fields: dict = None):
         """
         Retrieve a provisioning profile from App Store Connect API.
 
         :param provisioning_profile_id: ID of the provisioning profile to retrieve.
         :type provisioning_profile_id: str
+        :param fields: Sparse fieldsets, e.g. PROFILE_METADATA_FIELDS. See fields_params.
         :return: JSON representation of the retrieved provisioning profile.
         :rtype: dict or None if the retrieval fails.
         """
+        profile_fields = self.__type_fields(fields, "profiles")
+        if self.__cache is not None and self.__cache.is_fresh("profiles", profile_fields):
+            profile = self.__cache.get("profiles", provisioning_profile_id)
+            if profile is not None:
+                return {"data": profile}
         try:
-            self.__update_header()
-            response = requests.get(f"https://api.appstoreconnect.apple.com/v1/profiles/{provisioning_profile_id}",
-                                    headers=self.__header)
+            response = self.__request("GET", f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}",
+                                      params=self.fields_params(fields))
             if not response.ok:
-                print(response.text)
                 return None
-            return response.json()
+            profile = response.json()
+            if self.__cache is not None:
+                self.__cache.upsert(profile["data"], partial=profile_fields is not None)
+            return profile
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return None
 
-    def get_certificates_of_related_provisioning_profile(self, provisioning_profile_id: str):
+    def get_certificates_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None):
         """
         Method to get the certificates associated with a provisioning profile.
 
         :param provisioning_profile_id: The ID of the provisioning profile.
+        :param fields: Sparse fieldsets, e.g. {"certificates": ["name", "serialNumber"]}. See fields_params.
         :return: A JSON object containing the certificates related to the provisioning profile.
         """
         try:
-            self.__update_header()
-            response = requests.get(
-                f'https://api.appstoreconnect.apple.com/v1/profiles/{provisioning_profile_id}/certificates',
-                headers=self.__header)
+            response = self.__request("GET", f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}/certificates",
+                                      params=self.fields_params(fields))
             if not response.ok:
-                print(response.text)
                 return None
             return response.json()
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return None
 
-    def get_bundle_id_of_related_provisioning_profile(self, provisioning_profile_id: str):
+    def get_bundle_id_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None):
         """
         Retrieves the bundle identifier of the provisioning profile with the specified ID.
 
         :param provisioning_profile_id: The ID of the provisioning profile.
+        :param fields: Sparse fieldsets, e.g. {"bundleIds": ["identifier"]}. See fields_params.
         :return: The bundle identifier of the provisioning profile, or None if an error occurs.
         """
         try:
-            self.__update_header()
-            response = requests.get(
-                f"https://api.appstoreconnect.apple.com/v1/profiles/{provisioning_profile_id}/bundleId",
-                headers=self.__header)
+            response = self.__request("GET", f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}/bundleId",
+                                      params=self.fields_params(fields))
             if not response.ok:
-                print(response.text)
                 return None
             return response.json()
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return None
 
-    def get_devices_of_related_provisioning_profile(self, provisioning_profile_id: str):
+    def get_devices_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None):
         """
         Method: get_devices_of_related_provisioning_profile
 
@@ -190,6 +1020,7 @@ class AppStoreConnectApiWrapper:
 
         :param provisioning_profile_id: The ID of the provisioning profile for which to retrieve the associated devices.
         :type provisioning_profile_id: str
+        :param fields: Sparse fieldsets, e.g. DEVICE_METADATA_FIELDS. See fields_params.
         :return: The list of devices associated with the provisioning profile. Returns None if an error occurs.
         :rtype: dict or None
 
@@ -200,16 +1031,91 @@ class AppStoreConnectApiWrapper:
             >> {'data': [{'id': 'device1', 'name': 'Device 1'}, {'id': 'device2', 'name': 'Device 2'}]}
         """
         try:
-            self.__update_header()
-            response = requests.get(
-                f"https://api.appstoreconnect.apple.com/v1/profiles/{provisioning_profile_id}/devices",
-                headers=self.__header)
+            return self.__collect_list(
+                self.__iter_resources(f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}/devices", fields=fields))
+        except requests.exceptions.RequestException as e:
+            logger.error("%s", e)
+            return None
+
+    @staticmethod
+    def index_resources(document: dict) -> dict:
+        """
+        Indexes the primary data and the included resources of a compound document by (type, id).
+
+        :param document: A JSON:API document returned by the App Store Connect API.
+        :return: A dict mapping (type, id) tuples to resource objects.
+        """
+        data = document.get("data")
+        resources = data if isinstance(data, list) else [data] if data else []
+        index = {}
+        for resource in resources + document.get("included", []):
+            index[(resource["type"], resource["id"])] = resource
+        return index
+
+    def get_profile_with_relationships(self, provisioning_profile_id: str, fields: dict = None):
+        """
+        Retrieves a provisioning profile together with its bundleId, certificates and devices in one request,
+        using the include parameter of the profiles endpoint.
+
+        The API embeds at most INCLUDE_LIMIT related resources per relationship. When a relationship has more,
+        the remaining resources are fetched from the paginated relationship endpoint.
+
+        :param provisioning_profile_id: The ID of the provisioning profile.
+        :param fields: Sparse fieldsets of the profile and the related resources, e.g. PROFILE_RELATIONSHIP_FIELDS.
+                       See fields_params. The relationships are always requested.
+        :return: A dict like {"profile": {...}, "bundleId": {...}, "certificates": [...], "devices": [...]}
+                 holding resource objects, or None if an error occurs.
+        :rtype: dict or None
+        """
+        params = {
+            "include": "bundleId,certificates,devices",
+            "limit[certificates]": self.INCLUDE_LIMIT,
+            "limit[devices]": self.INCLUDE_LIMIT
+        }
+        if fields is not None and "profiles" in fields:
+            fields = dict(fields)
+            fields["profiles"] = tuple(fields["profiles"]) + tuple(
+                name for name in ("bundleId", "certificates", "devices") if name not in fields["profiles"])
+        params.update(self.fields_params(fields))
+        try:
+            response = self.__request("GET", f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}", params=params)
             if not response.ok:
-                print(response.text)
                 return None
-            return response.json()
+            document = response.json()
+            index = self.index_resources(document)
+            profile = document["data"]
+            relationships = profile.get("relationships", {})
+
+            def resolve(name: str):
+                relationship = relationships.get(name, {})
+                linkage = relationship.get("data")
+                if linkage is None:
+                    return None
+                if isinstance(linkage, dict):
+                    return index.get((linkage["type"], linkage["id"]), linkage)
+                total = relationship.get("meta", {}).get("paging", {}).get("total", len(linkage))
+                if total > len(linkage):
+                    related_fields = {name: fields[name]} if fields is not None and name in fields else None
+                    return list(self.__iter_resources(f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}/{name}",
+                                                      fields=related_fields))
+                return [index.get((item["type"], item["id"]), item) for item in linkage]
+
+            graph = {
+                "profile": profile,
+                "bundleId": resolve("bundleId"),
+                "certificates": resolve("certificates"),
+                "devices": resolve("devices")
+            }
+            if graph["bundleId"] is None or graph["certificates"] is None or graph["devices"] is None:
+                logger.error("profile relationships are missing in the response")
+                return None
+            if self.__cache is not None:
+                for resource in [graph["bundleId"]] + graph["certificates"]:
+                    if "attributes" in resource:
+                        self.__cache.upsert(resource, partial=self.__type_fields(fields, resource["type"]) is not None)
+            return graph
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return None
 
     def register_device(self, deviceName: str, deviceUdid: str, devicePlatform: str) -> bool:
@@ -222,7 +1128,6 @@ class AppStoreConnectApiWrapper:
         :return: True if the device was registered successfully, False if an exception occurred or if the response was not OK.
         """
         try:
-            self.__update_header()
             payload = {
                 "data": {
                     "type": "devices",
@@ -233,16 +1138,84 @@ class AppStoreConnectApiWrapper:
                     }
                 }
             }
-            response = requests.post(self.ENDPOINT_DEVICES, headers=self.__header, json=payload)
+            response = self.__request("POST", self.ENDPOINT_DEVICES, json=payload)
             if not response.ok:
-                print(response.text)
                 return None
-            return response.json()
+            device = response.json()
+            if self.__cache is not None:
+                self.__cache.upsert(device["data"])
+            return device
 
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return False
 
+    @staticmethod
+    def normalize_udid(udid: str) -> str:
+        """
+        :return: The UDID in the form used to compare devices, i.e. without surrounding whitespace and lower cased.
+        """
+        return udid.strip().lower()
+
+    @_workflow
+    def register_devices(self, devices, max_workers: int = 4, dry_run: bool = False):
+        """
+        Registers many devices, skipping the ones that are already registered.
+
+        The registered UDIDs are loaded once, with DEVICE_METADATA_FIELDS only, into a set. The input is consumed lazily, UDIDs repeated
+        in the input are registered only once, and the new devices are registered by a pool of
+        max_workers threads with at most 2 * max_workers registrations queued at a time.
+
+        :param devices: An iterable of (name, udid) or (name, udid, platform) tuples. The platform defaults to IOS.
+        :param max_workers: Number of registrations sent concurrently.
+        :param dry_run: Report the devices that would be registered without registering them.
+        :return: A list with one result per input device, in input order, or None if the registered devices could
+                 not be retrieved. Each result is a dict with the keys "name", "udid", "platform", "status" and
+                 "device". status is one of "created", "already_present" (registered before this call),
+                 "duplicate" (the UDID appeared earlier in the input, whose result tells its outcome), "failed" or,
+                 in dry run, "would_create". device holds the created device resource.
+        :rtype: list or None
+        """
+        registered_devices = self.get_device_list(self.DEVICE_METADATA_FIELDS)
+        if registered_devices is None:
+            return None
+        known_udids = {self.normalize_udid(device["attributes"]["udid"]) for device in registered_devices["data"]}
+        seen_udids = set()
+
+        results = []
+        in_flight = threading.BoundedSemaphore(max_workers * 2)
+
+        def register(result: dict):
+            result["status"] = "failed"
+            try:
+                created = self.register_device(result["name"], result["udid"], result["platform"])
+                if created:
+                    result["status"] = "created"
+                    result["device"] = created["data"]
+            finally:
+                in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AppStoreConnectRegister") as executor:
+            for device in devices:
+                name, udid, platform = (tuple(device) + ("IOS",))[:3]
+                result = {"name": name, "udid": udid, "platform": platform, "status": "already_present",
+                          "device": None}
+                results.append(result)
+                key = self.normalize_udid(udid)
+                if key in seen_udids:
+                    result["status"] = "duplicate"
+                    continue
+                seen_udids.add(key)
+                if key in known_udids:
+                    continue
+                if dry_run:
+                    result["status"] = "would_create"
+                    continue
+                in_flight.acquire()
+                self.__submit(executor, register, result)
+
+        return results
+
     def delete_profile(self, provisioning_profile_id: str):
         """
         Delete a provisioning profile.
@@ -263,164 +1236,259 @@ class AppStoreConnectApiWrapper:
             - This method requires the 'provisioning_profile_id' parameter to be a valid string identifier of an existing provisioning profile.
             - This method relies on the 'requests' module to make the HTTP request.
         """
-        response = requests.delete(f"https://api.appstoreconnect.apple.com/v1/profiles/{provisioning_profile_id}",
-                                   headers=self.__header)
+        response = self.__request("DELETE", f"{self.ENDPOINT_PROFILES}/{provisioning_profile_id}")
         if not response.status_code == 204:
-            print(response.text)
             return False
 
+        if self.__cache is not None:
+            self.__cache.delete("profiles", provisioning_profile_id)
         return True
 
-    def duplicate_provisioning_profile(self, provisioning_profile_id: str, duplicate_name: str):
+    @staticmethod
+    def build_profile_request_body(name: str, profile_type: str, bundle_id: str, device_ids: list,
+                                   certificate_ids: list) -> dict:
         """
-        :param provisioning_profile_id: The ID of the provisioning profile to be duplicated.
-        :param duplicate_name: The name of the duplicated provisioning profile.
-        :return: The response JSON from the create profile request, or None if an error occurs.
+        Builds the request body of a create profile request.
 
-        This method duplicates a provisioning profile by creating a new profile with the specified duplicate name and copying the attributes, bundle IDs, devices, and certificates from the source
-        * profile.
-
-        The method first retrieves the information of the source profile using the provisioning profile ID. If the source profile is not found, None is returned.
-
-        Next, it retrieves the certificates, bundle IDs, and devices related to the source profile. If any of these related entities is not found, None is returned.
-
-        Then, it constructs the request body for creating a duplicate profile based on the retrieved information. The duplicate profile will have the specified duplicate name and the same profile
-        * type as the source profile. It will also have relationships with the same bundle IDs, devices, and certificates.
-
-        The method sends a POST request to the endpoint for creating profiles with the request body. If the request is successful, the response JSON is returned. Otherwise, None is returned
-        *.
-
-        If an error occurs during the request or response handling, the error is printed and None is returned.
+        :param name: The name of the new profile.
+        :param profile_type: The profileType attribute, e.g. IOS_APP_DEVELOPMENT.
+        :param bundle_id: The resource id of the related bundleId.
+        :param device_ids: The resource ids of the related devices.
+        :param certificate_ids: The resource ids of the related certificates.
+        :return: The request body as a dict.
         """
-        src_profile_info = self.get_profile(provisioning_profile_id)
-        if src_profile_info is None:
-            return None
-
-        related_certificates = self.get_certificates_of_related_provisioning_profile(provisioning_profile_id)
-        related_bundle_ids = self.get_bundle_id_of_related_provisioning_profile(provisioning_profile_id)
-        related_devices = self.get_devices_of_related_provisioning_profile(provisioning_profile_id)
-
-        if related_certificates is None or related_bundle_ids is None or related_devices is None:
-            return None
-
-        backup_request_body = {
+        return {
             "data": {
                 "type": "profiles",
                 "attributes": {
-                    "name": duplicate_name,
-                    "profileType": src_profile_info[ "data" ][ "attributes" ][ "profileType" ]
+                    "name": name,
+                    "profileType": profile_type
                 },
                 "relationships": {
                     "bundleId": {
                         "data": {
                             "type": "bundleIds",
-                            "id": related_bundle_ids[ "data" ][ "id" ]
+                            "id": bundle_id
                         }
                     },
                     "devices": {
-                        "data": [
-                            {"type": "devices", "id": device_id[ "id" ]} for device_id in related_devices[ "data" ]
-                        ]
+                        "data": [{"type": "devices", "id": device_id} for device_id in device_ids]
                     },
                     "certificates": {
-                        "data": [
-                            {"type": "certificates", "id": certificate_id[ "id" ]} for certificate_id in
-                            related_certificates[ "data" ]
-                        ]
+                        "data": [{"type": "certificates", "id": certificate_id} for certificate_id in certificate_ids]
                     }
                 }
             }
         }
+
+    def create_profile(self, name: str, profile_type: str, bundle_id: str, device_ids: list, certificate_ids: list):
+        """
+        Creates a provisioning profile.
+
+        :param name: The name of the new profile.
+        :param profile_type: The profileType attribute, e.g. IOS_APP_DEVELOPMENT.
+        :param bundle_id: The resource id of the related bundleId.
+        :param device_ids: The resource ids of the devices to include.
+        :param certificate_ids: The resource ids of the certificates to include.
+        :return: The response JSON of the create profile request, or None if an error occurs.
+        """
+        body = self.build_profile_request_body(name, profile_type, bundle_id, device_ids, certificate_ids)
         try:
-            create_profile_res = requests.post(self.ENDPOINT_PROFILES, headers=self.__header, json=backup_request_body)
-            if not create_profile_res.ok:
-                print(create_profile_res.text)
+            response = self.__request("POST", self.ENDPOINT_PROFILES, json=body)
+            if not response.ok:
                 return None
-            return create_profile_res.json()
-
+            profile = response.json()
+            if self.__cache is not None:
+                self.__cache.upsert(profile["data"])
+            return profile
         except requests.exceptions.RequestException as e:
-            print(e)
+            logger.error("%s", e)
             return None
 
-    def update_provisioning_profile_all_devices(self, provisioning_profile_name: str):
+    @_workflow
+    def duplicate_provisioning_profile(self, provisioning_profile_id: str, duplicate_name: str,
+                                       profile_graph: dict = None):
         """
-        :param provisioning_profile_name: The name of the provisioning profile to update all devices for.
-        :return: The result of updating the provisioning profile with all devices. Returns None if there was an error.
+        :param provisioning_profile_id: The ID of the provisioning profile to be duplicated.
+        :param duplicate_name: The name of the duplicated provisioning profile.
+        :param profile_graph: The result of get_profile_with_relationships for the source profile, if the caller
+                              already has it. It is fetched when None.
+        :return: The response JSON from the create profile request, or None if an error occurs.
+
+        This method duplicates a provisioning profile by creating a new profile with the specified duplicate name and copying the attributes, bundle IDs, devices, and certificates from the source
+        * profile.
+
+        The method first retrieves the source profile together with its certificates, bundle ID and devices in a single request. If the source profile or any of these related entities is not
+        * found, None is returned.
+
+        Then, it constructs the request body for creating a duplicate profile based on the retrieved information. The duplicate profile will have the specified duplicate name and the same profile
+        * type as the source profile. It will also have relationships with the same bundle IDs, devices, and certificates.
+
+        The method sends a POST request to the endpoint for creating profiles with the request body. If the request is successful, the response JSON is returned. Otherwise, None is returned
+        *.
+
+        If an error occurs during the request or response handling, the error is printed and None is returned.
         """
-        try:
-            self.__update_header()
-            list = self.get_profile_list(provisioning_profile_name)
-            if list is None:
-                return None
+        if profile_graph is None:
+            profile_graph = self.get_profile_with_relationships(provisioning_profile_id,
+                                                                self.PROFILE_RELATIONSHIP_FIELDS)
+        if profile_graph is None:
+            return None
 
-            if len(list[ "data" ]) <= 0:
-                return None
+        return self.create_profile(duplicate_name,
+                                   profile_graph[ "profile" ][ "attributes" ][ "profileType" ],
+                                   profile_graph[ "bundleId" ][ "id" ],
+                                   [device[ "id" ] for device in profile_graph[ "devices" ]],
+                                   [certificate[ "id" ] for certificate in profile_graph[ "certificates" ]])
 
-            target_profile = None
-            for profile in list[ "data" ]:
-                if profile[ "attributes" ][ "name" ] == provisioning_profile_name:
-                    target_profile = profile
+    @staticmethod
+    def write_file_atomically(path: str, data: bytes):
+        """
+        Writes data to a temporary file next to path and renames it over path,
+        so readers never see a partially written file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".tmp_", delete=False) as file:
+            try:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                file.close()
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, path)
 
-            if target_profile is None:
-                print("provisioning profile not found")
-                return None
+    @staticmethod
+    def profile_file_name(profile_name: str) -> str:
+        """
+        :return: The file name a profile is saved as, i.e. its name with path separators replaced.
+        """
+        return profile_name.replace("/", "_").replace(os.sep, "_") + ".mobileprovision"
 
-            target_profile_id = target_profile[ "id" ]
+    @_workflow
+    def download_profiles(self, output_dir: str, name: str = None, profile_type: str = None, bundle_id: str = None,
+                          bundle_identifier: str = None, name_pattern: str = None, max_workers: int = 4):
+        """
+        Saves the matching provisioning profiles to output_dir as <name>.mobileprovision.
 
-            duplicate_result = self.duplicate_provisioning_profile(target_profile[ "id" ],
-                                                                   "backup_" + target_profile[ "attributes" ][ "name" ])
-            if duplicate_result is None:
-                return None
+        The profiles are listed with find_profiles without their content, then filtered by name_pattern.
+        A manifest file in output_dir remembers the id, expirationDate and SHA-256 of every saved profile.
+        Profiles whose id and expirationDate match the manifest and whose file on disk still has the recorded
+        hash are skipped without downloading their content, as are profiles whose downloaded content equals
+        the file on disk. Files are written through a temporary file and a rename. The profiles are processed
+        by a pool of max_workers threads.
 
-            # get related info
-            related_certificates = self.get_certificates_of_related_provisioning_profile(target_profile_id)
-            related_bundle_ids = self.get_bundle_id_of_related_provisioning_profile(target_profile_id)
-            all_devices = self.get_device_list()
-            if related_certificates is None or related_bundle_ids is None or all_devices is None:
-                return None
+        :param output_dir: The directory to save the profiles to. It is created if missing.
+        :param name: The exact name of the profile.
+        :param profile_type: The profileType, e.g. IOS_APP_ADHOC.
+        :param bundle_id: The resource id of the related bundle ID.
+        :param bundle_identifier: The identifier of the related bundle ID, e.g. com.example.app.
+        :param name_pattern: A shell style pattern the profile names must match, e.g. "AdHoc *".
+        :param max_workers: Number of profiles processed concurrently.
+        :return: A dict mapping each profile name to "downloaded", "unchanged" or "failed",
+                 or None if the profiles could not be retrieved.
+        :rtype: dict or None
+        """
+        profiles = self.find_profiles(name=name, profile_type=profile_type, bundle_id=bundle_id,
+                                      bundle_identifier=bundle_identifier, fields=self.PROFILE_METADATA_FIELDS)
+        if profiles is None:
+            return None
+        if name_pattern is not None:
+            profiles = [profile for profile in profiles
+                        if fnmatch.fnmatchcase(profile[ "attributes" ][ "name" ], name_pattern)]
+
+        os.makedirs(output_dir, exist_ok=True)
+        manifest_path = os.path.join(output_dir, self.PROFILE_MANIFEST_FILE_NAME)
+        try:
+            with open(manifest_path, "r") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = {}
 
-            # delete original
-            delete_res = self.delete_profile(target_profile[ "id" ])
-            if not delete_res:
+        def file_digest(path: str):
+            try:
+                with open(path, "rb") as file:
+                    return hashlib.sha256(file.read()).hexdigest()
+            except OSError:
                 return None
 
-            body = {
-                "data": {
-                    "type": "profiles",
-                    "attributes": {
-                        "name": target_profile[ "attributes" ][ "name" ],
-                        "profileType": target_profile[ "attributes" ][ "profileType" ]
-                    },
-                    "relationships": {
-                        "bundleId": {
-                            "data": {
-                                "type": "bundleIds",
-                                "id": related_bundle_ids[ "data" ][ "id" ]
-                            }
-                        },
-                        "devices": {
-                            "data": [
-                                {"type": "devices", "id": device_id[ "id" ]} for device_id in all_devices[ "data" ]
-                            ]
-                        },
-                        "certificates": {
-                            "data": [
-                                {"type": "certificates", "id": certificate_id[ "id" ]} for certificate_id in
-                                related_certificates[ "data" ]
-                            ]
-                        }
-                    }
-                }
-            }
-            create_profile_res = requests.post(self.ENDPOINT_PROFILES, headers=self.__header, json=body)
+        def download(profile: dict):
+            attributes = profile[ "attributes" ]
+            path = os.path.join(output_dir, self.profile_file_name(attributes[ "name" ]))
+            recorded = manifest.get(attributes[ "name" ], {})
+            on_disk = file_digest(path)
+            if recorded.get("id") == profile[ "id" ] and recorded.get("expirationDate") == attributes.get(
+                    "expirationDate") and on_disk is not None and recorded.get("sha256") == on_disk:
+                return "unchanged", recorded
 
-            if not create_profile_res.ok:
-                print(create_profile_res.text)
-                return None
+            encoded = attributes.get("profileContent")
+            if encoded is None:
+                fetched = self.get_profile(profile[ "id" ], {"profiles": ("profileContent",)})
+                if fetched is None:
+                    raise ValueError(f"failed to download the content of {attributes[ 'name' ]}")
+                encoded = fetched[ "data" ][ "attributes" ][ "profileContent" ]
+            content = base64.b64decode(encoded)
+            digest = hashlib.sha256(content).hexdigest()
+            entry = {"id": profile[ "id" ], "expirationDate": attributes.get("expirationDate"), "sha256": digest}
+            if digest == on_disk:
+                return "unchanged", entry
+            self.write_file_atomically(path, content)
+            return "downloaded", entry
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AppStoreConnectDownload") as executor:
+            futures = {profile[ "attributes" ][ "name" ]: self.__submit(executor, download, profile) for profile in profiles}
+            for profile_name, future in futures.items():
+                try:
+                    results[ profile_name ], manifest[ profile_name ] = future.result()
+                except Exception as e:
+                    logger.error("%s", e)
+                    results[ profile_name ] = "failed"
 
-            self.delete_profile(duplicate_result[ "data" ][ "id" ])
+        self.write_file_atomically(manifest_path, json.dumps(manifest, indent=2, sort_keys=True).encode())
+        return results
 
-            return create_profile_res.json()
+    @_workflow
+    def update_provisioning_profile_all_devices(self, provisioning_profile_name: str):
+        """
+        Refreshes a provisioning profile with every enabled device through refresh_planner: the profile is deleted
+        and created again, and restored with its original devices if the creation is rejected.
+
+        :param provisioning_profile_name: The name of the provisioning profile to update all devices for.
+        :return: The result of updating the provisioning profile with all devices. Returns None if there was an error.
+        """
+        try:
+            plan = self.__refresh_planner.plan(provisioning_profile_name, force=True)
+            if plan is None:
+                return None
+            return self.__refresh_planner.apply(plan)
         except Exception as e:
-            print(e)
+            logger.error("%s", e)
+            return None
+
+    @_workflow
+    def update_provisioning_profiles_all_devices(self, profile_names: list = None, name_pattern: str = None,
+                                                 max_workers: int = 4, force: bool = False):
+        """
+        Updates many provisioning profiles so that each of them contains every enabled device.
+
+        The device list is fetched once and shared by every profile. Each profile is fetched with its
+        relationships and compared with the device list, and only the profiles missing devices are
+        refreshed through refresh_planner. The profiles are processed by a pool of max_workers threads.
+
+        :param profile_names: Exact names of the profiles to update.
+        :param name_pattern: A shell style pattern such as "Development *". Every profile whose name matches is updated.
+        :param max_workers: Number of profiles processed concurrently.
+        :param force: Regenerate the profiles even if they already contain every device.
+        :return: A dict mapping each profile name to a result dict with the keys "status" and "profile".
+                 status is one of "updated", "up_to_date", "not_found", "restored" or "failed", and profile holds
+                 the response JSON of the created profile. None is returned if the devices or profiles could not
+                 be retrieved. See ProfileRefreshPlanner.refresh_all.
+        :rtype: dict or None
+        """
+        results = self.__refresh_planner.refresh_all(profile_names, name_pattern, max_workers, force)
+        if results is None:
             return None
+        return {name: {"status": result[ "status" ], "profile": result[ "profile" ]}
+                for name, result in results.items()}
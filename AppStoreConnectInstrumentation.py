@@ -0,0 +1,272 @@
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import uuid
+
+_current_span = contextvars.ContextVar("app_store_connect_span", default=None)
+
+
+class RequestEvent:
+    """
+    RequestEvent class describes one request sent to the App Store Connect API, including its retries.
+
+    Attributes:
+        method: str - The HTTP method.
+        endpoint: str - The URL path with resource ids replaced by {id}, e.g. /v1/profiles/{id}/devices.
+        url: str - The requested URL without query parameters.
+        status: int - The status code of the last response, or None if no response was received.
+        latency: float - Seconds from the first attempt to the last response, including rate limit waits.
+        bytes: int - Size of the last response body.
+        retries: int - Number of retries.
+        rate_limit_remaining: int - Remaining hourly quota after the request, or None if unknown.
+        span_id: str - Id of the workflow span the request belongs to, or None.
+        span_name: str - Name of the workflow span, e.g. update_provisioning_profile_all_devices, or None.
+        error: str - The exception raised by the request, or None.
+    """
+    __slots__ = ("method", "endpoint", "url", "status", "latency", "bytes", "retries", "rate_limit_remaining",
+                 "span_id", "span_name", "error")
+
+    def __init__(self, method: str, endpoint: str, url: str, status: int, latency: float, bytes: int,
+                 retries: int, rate_limit_remaining: int, span_id: str = None, span_name: str = None,
+                 error: str = None):
+        self.method = method
+        self.endpoint = endpoint
+        self.url = url
+        self.status = status
+        self.latency = latency
+        self.bytes = bytes
+        self.retries = retries
+        self.rate_limit_remaining = rate_limit_remaining
+        self.span_id = span_id
+        self.span_name = span_name
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"RequestEvent({self.to_dict()!r})"
+
+
+def endpoint_of(path: str) -> str:
+    """
+    :param path: A URL path such as /v1/profiles/ABCDE12345/devices.
+    :return: The path with the resource id replaced, such as /v1/profiles/{id}/devices.
+    """
+    parts = path.split("/")
+    if len(parts) > 3 and parts[3]:
+        parts[3] = "{id}"
+    return "/".join(parts)
+
+
+def current_span() -> tuple:
+    """
+    :return: The (span_id, span_name) of the workflow span of the current context, or (None, None).
+    """
+    return _current_span.get() or (None, None)
+
+
+@contextlib.contextmanager
+def workflow_span(name: str):
+    """
+    Marks the requests sent inside the with block as belonging to one workflow.
+    If a span is already active, the requests keep belonging to it.
+
+    :param name: The name of the workflow.
+    :return: A context manager yielding the span id.
+    """
+    active = _current_span.get()
+    if active is not None:
+        yield active[0]
+        return
+    token = _current_span.set((uuid.uuid4().hex, name))
+    try:
+        yield _current_span.get()[0]
+    finally:
+        _current_span.reset(token)
+
+
+class LoggingSink:
+    """
+    LoggingSink class writes every RequestEvent as one JSON log record.
+    The event is also attached to the record as the app_store_connect attribute for structured handlers.
+
+    Methods:
+        __init__(self, logger: logging.Logger = None, level: int = logging.INFO, error_level: int = logging.WARNING)
+        __call__(self, event: RequestEvent)"""
+
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO, error_level: int = logging.WARNING):
+        """
+        :param logger: The logger to write to. Defaults to the "AppStoreConnectApiWrapper.requests" logger.
+        :param level: Level of the events of successful requests.
+        :param error_level: Level of the events of failed requests.
+        """
+        self.logger = logger if logger is not None else logging.getLogger("AppStoreConnectApiWrapper.requests")
+        self.level = level
+        self.error_level = error_level
+
+    def __call__(self, event: RequestEvent):
+        failed = event.error is not None or event.status is None or event.status >= 400
+        fields = event.to_dict()
+        self.logger.log(self.error_level if failed else self.level, json.dumps(fields, sort_keys=True),
+                        extra={"app_store_connect": fields})
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """
+    Counter class is a monotonically increasing metric with labels.
+
+    Methods:
+        inc(self, *label_values, amount: float = 1.0)
+        value(self, *label_values) -> float
+        render(self) -> list"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.__lock = threading.Lock()
+        self.__values = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        with self.__lock:
+            return self.__values.get(label_values, 0.0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.__lock:
+            for label_values, value in sorted(self.__values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """
+    Gauge class is a metric with labels that can be set to any value.
+
+    Methods:
+        set(self, *label_values, value: float)"""
+
+    def set(self, *label_values, value: float):
+        self.inc(*label_values, amount=value - self.value(*label_values))
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    """
+    Histogram class counts observations in cumulative buckets, per label values.
+
+    Attributes:
+        DEFAULT_BUCKETS: tuple - Upper bounds suited to request latencies in seconds.
+
+    Methods:
+        observe(self, *label_values, value: float)
+        snapshot(self, *label_values) -> dict
+        render(self) -> list"""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.__lock = threading.Lock()
+        self.__series = {}
+
+    def observe(self, *label_values, value: float):
+        with self.__lock:
+            series = self.__series.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, *label_values) -> dict:
+        """
+        :return: The cumulative bucket counts, sum and count of the label values, like
+                 {"buckets": {0.005: 1, ..., "+Inf": 3}, "sum": 0.42, "count": 3}.
+        """
+        with self.__lock:
+            counts, total, count = self.__series.get(label_values, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            cumulative = {}
+            running = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                running += bucket_count
+                cumulative[bound] = running
+            return {"buckets": cumulative, "sum": total, "count": count}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.__lock:
+            keys = sorted(self.__series)
+        for label_values in keys:
+            snapshot = self.snapshot(*label_values)
+            for bound, count in snapshot["buckets"].items():
+                labels = _format_labels(self.label_names + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {snapshot['sum']}")
+            lines.append(f"{self.name}_count{labels} {snapshot['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    MetricsRegistry class aggregates RequestEvents into Prometheus style metrics and renders them in the
+    Prometheus text exposition format. Register it as an observer of AppStoreConnectApiWrapper.
+
+    Attributes:
+        requests: Counter - Requests per method, endpoint and status.
+        retries: Counter - Retries per method and endpoint.
+        response_bytes: Counter - Response body bytes per method and endpoint.
+        latency: Histogram - Request latency in seconds per method and endpoint.
+        rate_limit_remaining: Gauge - Last reported remaining hourly quota.
+
+    Methods:
+        __call__(self, event: RequestEvent)
+        render(self) -> str"""
+
+    def __init__(self, namespace: str = "appstoreconnect"):
+        self.requests = Counter(f"{namespace}_requests_total", "Requests sent to App Store Connect.",
+                                ("method", "endpoint", "status"))
+        self.retries = Counter(f"{namespace}_request_retries_total", "Retries of App Store Connect requests.",
+                               ("method", "endpoint"))
+        self.response_bytes = Counter(f"{namespace}_response_bytes_total", "Bytes received from App Store Connect.",
+                                      ("method", "endpoint"))
+        self.latency = Histogram(f"{namespace}_request_duration_seconds",
+                                 "Latency of App Store Connect requests including retries.", ("method", "endpoint"))
+        self.rate_limit_remaining = Gauge(f"{namespace}_rate_limit_remaining",
+                                          "Remaining hourly App Store Connect request quota.")
+
+    def __call__(self, event: RequestEvent):
+        status = "error" if event.status is None else str(event.status)
+        self.requests.inc(event.method, event.endpoint, status)
+        if event.retries:
+            self.retries.inc(event.method, event.endpoint, amount=event.retries)
+        self.response_bytes.inc(event.method, event.endpoint, amount=event.bytes)
+        self.latency.observe(event.method, event.endpoint, value=event.latency)
+        if event.rate_limit_remaining is not None:
+            self.rate_limit_remaining.set(value=event.rate_limit_remaining)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.requests, self.retries, self.response_bytes, self.latency, self.rate_limit_remaining):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
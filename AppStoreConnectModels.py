@@ -0,0 +1,194 @@
+import base64
+import sys
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _related_id(resource: dict, name: str):
+    linkage = resource.get("relationships", {}).get(name, {}).get("data")
+    return linkage["id"] if isinstance(linkage, dict) else None
+
+
+def _related_ids(resource: dict, name: str):
+    linkage = resource.get("relationships", {}).get(name, {}).get("data")
+    return tuple(item["id"] for item in linkage) if isinstance(linkage, list) else None
+
+
+class _Model:
+    """
+    Base class of the resource models. Subclasses list their fields in __slots__ and
+    build instances from the resource objects of API responses with from_resource.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if not name.startswith("_"))
+        return f"{type(self).__name__}({fields})"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self):
+        return hash((type(self), self.id))
+
+
+class Device(_Model):
+    """
+    Device class holds the attributes of a devices resource.
+
+    Attributes:
+        id, name, udid, platform, status, device_class, model, added_date
+    """
+    __slots__ = ("id", "name", "udid", "platform", "status", "device_class", "model", "added_date")
+
+    def __init__(self, id: str, name: str, udid: str, platform: str = None, status: str = None,
+                 device_class: str = None, model: str = None, added_date: str = None):
+        self.id = id
+        self.name = name
+        self.udid = udid
+        self.platform = _intern(platform)
+        self.status = _intern(status)
+        self.device_class = _intern(device_class)
+        self.model = _intern(model)
+        self.added_date = added_date
+
+    @classmethod
+    def from_resource(cls, resource: dict):
+        attributes = resource.get("attributes", {})
+        return cls(resource["id"], attributes.get("name"), attributes.get("udid"), attributes.get("platform"),
+                   attributes.get("status"), attributes.get("deviceClass"), attributes.get("model"),
+                   attributes.get("addedDate"))
+
+
+class Certificate(_Model):
+    """
+    Certificate class holds the attributes of a certificates resource.
+    The certificate content is decoded from base64 only when content is read.
+
+    Attributes:
+        id, name, display_name, certificate_type, platform, serial_number, expiration_date, content
+    """
+    __slots__ = ("id", "name", "display_name", "certificate_type", "platform", "serial_number", "expiration_date",
+                 "_content")
+
+    def __init__(self, id: str, name: str, display_name: str = None, certificate_type: str = None,
+                 platform: str = None, serial_number: str = None, expiration_date: str = None,
+                 content: str = None):
+        self.id = id
+        self.name = name
+        self.display_name = display_name
+        self.certificate_type = _intern(certificate_type)
+        self.platform = _intern(platform)
+        self.serial_number = serial_number
+        self.expiration_date = expiration_date
+        self._content = content
+
+    @property
+    def content(self):
+        """
+        :return: The DER encoded certificate, or None if the response did not contain it.
+        :rtype: bytes or None
+        """
+        return None if self._content is None else base64.b64decode(self._content)
+
+    @classmethod
+    def from_resource(cls, resource: dict):
+        attributes = resource.get("attributes", {})
+        return cls(resource["id"], attributes.get("name"), attributes.get("displayName"),
+                   attributes.get("certificateType"), attributes.get("platform"), attributes.get("serialNumber"),
+                   attributes.get("expirationDate"), attributes.get("certificateContent"))
+
+
+class BundleId(_Model):
+    """
+    BundleId class holds the attributes of a bundleIds resource.
+
+    Attributes:
+        id, name, identifier, platform, seed_id
+    """
+    __slots__ = ("id", "name", "identifier", "platform", "seed_id")
+
+    def __init__(self, id: str, name: str, identifier: str, platform: str = None, seed_id: str = None):
+        self.id = id
+        self.name = name
+        self.identifier = identifier
+        self.platform = _intern(platform)
+        self.seed_id = _intern(seed_id)
+
+    @classmethod
+    def from_resource(cls, resource: dict):
+        attributes = resource.get("attributes", {})
+        return cls(resource["id"], attributes.get("name"), attributes.get("identifier"), attributes.get("platform"),
+                   attributes.get("seedId"))
+
+
+class Profile(_Model):
+    """
+    Profile class holds the attributes of a profiles resource and the ids of its relationships,
+    when the response contained them.
+
+    The profile content is kept as the base64 string of the response and decoded only when content is read,
+    so profiles that are only listed never hold the decoded .mobileprovision in memory.
+
+    Attributes:
+        id, name, profile_type, profile_state, platform, uuid, created_date, expiration_date,
+        bundle_id, certificate_ids, device_ids, content
+    """
+    __slots__ = ("id", "name", "profile_type", "profile_state", "platform", "uuid", "created_date",
+                 "expiration_date", "bundle_id", "certificate_ids", "device_ids", "_content")
+
+    def __init__(self, id: str, name: str, profile_type: str = None, profile_state: str = None,
+                 platform: str = None, uuid: str = None, created_date: str = None, expiration_date: str = None,
+                 bundle_id: str = None, certificate_ids: tuple = None, device_ids: tuple = None,
+                 content: str = None):
+        self.id = id
+        self.name = name
+        self.profile_type = _intern(profile_type)
+        self.profile_state = _intern(profile_state)
+        self.platform = _intern(platform)
+        self.uuid = uuid
+        self.created_date = created_date
+        self.expiration_date = expiration_date
+        self.bundle_id = bundle_id
+        self.certificate_ids = certificate_ids
+        self.device_ids = device_ids
+        self._content = content
+
+    @property
+    def content(self):
+        """
+        :return: The .mobileprovision file content, or None if the response did not contain it.
+        :rtype: bytes or None
+        """
+        return None if self._content is None else base64.b64decode(self._content)
+
+    @classmethod
+    def from_resource(cls, resource: dict):
+        attributes = resource.get("attributes", {})
+        return cls(resource["id"], attributes.get("name"), attributes.get("profileType"),
+                   attributes.get("profileState"), attributes.get("platform"), attributes.get("uuid"),
+                   attributes.get("createdDate"), attributes.get("expirationDate"),
+                   _related_id(resource, "bundleId"), _related_ids(resource, "certificates"),
+                   _related_ids(resource, "devices"), attributes.get("profileContent"))
+
+
+MODEL_TYPES = {
+    "devices": Device,
+    "certificates": Certificate,
+    "bundleIds": BundleId,
+    "profiles": Profile
+}
+
+
+def from_resource(resource: dict):
+    """
+    Builds the model of a resource object according to its type.
+
+    :param resource: A resource object of an API response.
+    :return: A Device, Certificate, BundleId or Profile.
+    :raises KeyError: If the resource type has no model.
+    """
+    return MODEL_TYPES[resource["type"]].from_resource(resource)
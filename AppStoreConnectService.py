@@ -0,0 +1,490 @@
+import argparse
+import hashlib
+import http.client
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from authlib.jose import JsonWebKey, JsonWebToken
+from authlib.jose.errors import JoseError
+
+from AppStoreConnectApiWrapper import AppStoreConnectApiWrapper
+from AppStoreConnectInstrumentation import LoggingSink, MetricsRegistry
+from InventoryCache import InventoryCache
+
+logger = logging.getLogger(__name__)
+
+PROOF_AUDIENCE = "appstoreconnect-service"
+PROOF_LIFETIME = 60
+_proof_jwt = JsonWebToken(["ES256"])
+
+
+def sign_request_proof(private_key, keyId: str, issuerId: str, body: bytes) -> str:
+    """
+    Signs the proof that the sender of a service request holds the API key: a short-lived ES256 JWT bound to
+    the SHA-256 of the request body.
+
+    :param private_key: The key of the .p8 file, as returned by JsonWebKey.import_key.
+    :return: The token, sent as "Authorization: Bearer <token>".
+    """
+    now = int(time.time())
+    header = {"alg": "ES256", "kid": keyId, "typ": "JWT"}
+    payload = {"iss": issuerId, "aud": PROOF_AUDIENCE, "iat": now, "exp": now + PROOF_LIFETIME,
+               "bdh": hashlib.sha256(body).hexdigest()}
+    return _proof_jwt.encode(header, payload, private_key).decode()
+
+
+def _list_devices(api: AppStoreConnectApiWrapper, params: dict):
+    return api.get_device_list(params.get("fields"))
+
+
+def _register_devices(api: AppStoreConnectApiWrapper, params: dict):
+    return api.register_devices(params["devices"], params.get("max_workers", 4), params.get("dry_run", False))
+
+
+def _download_profiles(api: AppStoreConnectApiWrapper, params: dict):
+    return api.download_profiles(params["output_dir"], params.get("name"), params.get("profile_type"),
+                                 params.get("bundle_id"), params.get("bundle_identifier"), params.get("name_pattern"),
+                                 params.get("max_workers", 4))
+
+
+def _refresh_profiles(api: AppStoreConnectApiWrapper, params: dict):
+    return api.update_provisioning_profiles_all_devices(params.get("profile_names"), params.get("name_pattern"),
+                                                        params.get("max_workers", 4), params.get("force", False))
+
+
+def _confine(root: str, path: str) -> str:
+    """
+    Resolves path relative to root.
+
+    :return: The real path.
+    :raises ValueError: If no root is configured or the path resolves outside of it.
+    """
+    if root is None:
+        raise ValueError(f"{path} is not allowed: no root directory is configured")
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"{path} is outside of {root}")
+    return resolved
+
+
+OPERATIONS = {
+    "devices/list": _list_devices,
+    "devices/register": _register_devices,
+    "profiles/download": _download_profiles,
+    "profiles/refresh": _refresh_profiles
+}
+
+
+class AppStoreConnectClientPool:
+    """
+    AppStoreConnectClientPool class keeps one warm AppStoreConnectApiWrapper per API key, so the key is parsed,
+    the token is signed and the connections are opened once instead of once per job.
+
+    Each account has its own bounded executor. Jobs of one account are queued and run in parallel up to
+    jobs_per_account, and a busy account does not delay the jobs of the others.
+
+    An account is identified by keyId, issuerId, the real path of the key file and the SHA-256 of its content,
+    which is read again for every job. authorize checks that a request is signed with that key, so callers that
+    only know the IDs or the path of a key can not use it. Key files must be inside key_root when it is set, and the output_dir of "profiles/download" must be inside
+    output_root, which is required for that operation.
+
+    Methods:
+        __init__(self, jobs_per_account: int = 4, cache_dir: str = None, cache_ttl: float = 600.0,
+                 base_url: str = None, observers: list = None, key_root: str = None, output_root: str = None,
+                 journal_dir: str = None, cache_paths: dict = None)
+        get(self, keyId: str, issuerId: str, p8FilePath: str) -> AppStoreConnectApiWrapper
+        authorize(self, keyId: str, issuerId: str, p8FilePath: str, proof: str, body: bytes)
+        submit(self, keyId: str, issuerId: str, p8FilePath: str, operation: str, params: dict) -> Future
+        accounts(self) -> list
+        close(self)"""
+
+    def __init__(self, jobs_per_account: int = 4, cache_dir: str = None, cache_ttl: float = 600.0,
+                 base_url: str = None, observers: list = None, key_root: str = None, output_root: str = None,
+                 journal_dir: str = None, cache_paths: dict = None):
+        """
+        :param jobs_per_account: Number of jobs of the same account run concurrently.
+        :param cache_dir: Directory of the InventoryCache files, one per account. No cache is used if None.
+        :param cache_ttl: Number of seconds the cached devices and profiles are used.
+        :param base_url: The base URL of the API. See AppStoreConnectApiWrapper.
+        :param observers: Request observers registered on every client, e.g. a MetricsRegistry.
+        :param key_root: Directory the key files must be in. Any readable key file is accepted if None.
+        :param output_root: Directory the downloads are written to. The output_dir of a job is relative to it.
+                            "profiles/download" is rejected if None.
+        :param journal_dir: Directory of the profile refresh journals, one subdirectory per account.
+                            Defaults to ProfileRefreshPlanner.DEFAULT_JOURNAL_DIR.
+        :param cache_paths: InventoryCache files of some accounts by (keyId, issuerId), used instead of cache_dir.
+        """
+        self.jobs_per_account = jobs_per_account
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.base_url = base_url
+        self.observers = list(observers or [])
+        self.key_root = key_root
+        self.output_root = output_root
+        self.journal_dir = journal_dir
+        self.cache_paths = dict(cache_paths or {})
+        self.__lock = threading.Lock()
+        self.__accounts = {}
+
+    def __create(self, keyId: str, issuerId: str, p8FilePath: str, digest: str) -> tuple:
+        account_name = f"{keyId}_{issuerId}_{digest[:16]}"
+        cache = None
+        if (keyId, issuerId) in self.cache_paths:
+            cache = InventoryCache(self.cache_paths[(keyId, issuerId)], self.cache_ttl)
+        elif self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            cache = InventoryCache(os.path.join(self.cache_dir, f"{account_name}.sqlite3"), self.cache_ttl)
+        api = AppStoreConnectApiWrapper(keyId, issuerId, p8FilePath, cache=cache, base_url=self.base_url,
+                                        pool_maxsize=max(16, self.jobs_per_account * 4), journal_dir=self.journal_dir)
+        for observer in self.observers:
+            api.add_observer(observer)
+        # parses the key and signs the first token before any job waits for it
+        api.token_manager.get_authorization_header()
+        executor = ThreadPoolExecutor(max_workers=self.jobs_per_account, thread_name_prefix=f"AppStoreConnect-{keyId}")
+        return api, executor
+
+    def __read_key(self, p8FilePath: str) -> tuple:
+        p8FilePath = os.path.realpath(p8FilePath) if self.key_root is None else _confine(self.key_root, p8FilePath)
+        with open(p8FilePath, "rb") as file:
+            return p8FilePath, file.read()
+
+    def __account(self, keyId: str, issuerId: str, p8FilePath: str) -> tuple:
+        p8FilePath, pem = self.__read_key(p8FilePath)
+        digest = hashlib.sha256(pem).hexdigest()
+        key = (keyId, issuerId, p8FilePath, digest)
+        with self.__lock:
+            account = self.__accounts.get(key)
+            if account is None:
+                account = self.__create(keyId, issuerId, p8FilePath, digest)
+                self.__accounts[key] = account
+            return account
+
+    def get(self, keyId: str, issuerId: str, p8FilePath: str) -> AppStoreConnectApiWrapper:
+        """
+        :return: The warm client of the API key. The key file is read on every call to check its content.
+        :raises OSError: If the key file can not be read.
+        :raises ValueError: If the key file is outside of key_root.
+        """
+        return self.__account(keyId, issuerId, p8FilePath)[0]
+
+    def authorize(self, keyId: str, issuerId: str, p8FilePath: str, proof: str, body: bytes):
+        """
+        Checks that a request was signed with the key in p8FilePath by sign_request_proof.
+
+        :param proof: The token sent with the request, or None.
+        :param body: The raw body of the request.
+        :raises PermissionError: If the proof is missing, expired, not signed with the key or not for this body.
+        :raises OSError: If the key file can not be read.
+        :raises ValueError: If the key file is outside of key_root.
+        """
+        if not proof:
+            raise PermissionError("the request is not signed with the API key")
+        pem = self.__read_key(p8FilePath)[1]
+        try:
+            claims = _proof_jwt.decode(proof, JsonWebKey.import_key(pem, {"kty": "EC"}), claims_options={
+                "iss": {"essential": True, "value": issuerId},
+                "aud": {"essential": True, "value": PROOF_AUDIENCE},
+                "exp": {"essential": True}})
+            claims.validate()
+        except (JoseError, ValueError) as e:
+            raise PermissionError(f"invalid request signature: {e}")
+        if claims.header.get("kid") != keyId or claims["exp"] > time.time() + PROOF_LIFETIME \
+                or claims.get("bdh") != hashlib.sha256(body).hexdigest():
+            raise PermissionError("the request signature does not match the key id or the body")
+
+    def submit(self, keyId: str, issuerId: str, p8FilePath: str, operation: str, params: dict) -> Future:
+        """
+        Queues a job on the executor of the account.
+
+        :param operation: One of OPERATIONS, e.g. "profiles/refresh".
+        :param params: The parameters of the operation.
+        :return: A Future of the operation result. The result is None if the API calls failed.
+        :raises KeyError: If the operation is unknown.
+        :raises ValueError: If the key file or the output_dir is outside of its root.
+        """
+        function = OPERATIONS[operation]
+        if operation == "profiles/download":
+            params = dict(params, output_dir=_confine(self.output_root, params["output_dir"]))
+        api, executor = self.__account(keyId, issuerId, p8FilePath)
+        return executor.submit(function, api, params)
+
+    def accounts(self) -> list:
+        """
+        :return: The (keyId, issuerId) of every warm client.
+        """
+        with self.__lock:
+            return [key[:2] for key in self.__accounts]
+
+    def close(self):
+        """
+        Waits for the queued jobs, then closes every client and its cache.
+        """
+        with self.__lock:
+            accounts = list(self.__accounts.values())
+            self.__accounts.clear()
+        for api, executor in accounts:
+            executor.shutdown(wait=True)
+            api.close()
+            if api.cache is not None:
+                api.cache.close()
+
+
+class AppStoreConnectService(ThreadingHTTPServer):
+    """
+    AppStoreConnectService class is a local daemon running the wrapper operations for short-lived callers,
+    such as CI jobs, on the warm clients of an AppStoreConnectClientPool.
+
+    It listens on a TCP address or, when address is a path, on a unix socket. Every operation is a POST to
+    /v1/<operation> with a JSON body holding keyId, issuerId, p8FilePath and the parameters of the operation,
+    signed with the API key by sign_request_proof in the Authorization header. The response is {"result": ...},
+    with status 502 if the API calls failed, 401 if the signature is missing or wrong, or 400 if the request is
+    invalid or a path is outside of the roots of the pool. The unix socket is only accessible to its owner. GET /health lists the warm
+    accounts and GET /metrics returns the request metrics in the Prometheus text format.
+
+    Methods:
+        __init__(self, address=("127.0.0.1", 8787), pool: AppStoreConnectClientPool = None,
+                 metrics: MetricsRegistry = None)
+        start(self)
+        stop(self)
+
+    Example usage:
+        with AppStoreConnectServiceClient("http://127.0.0.1:8787", keyId, issuerId, p8FilePath) as client:
+            client.call("profiles/refresh", name_pattern="Dev *")"""
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8787), pool: AppStoreConnectClientPool = None,
+                 metrics: MetricsRegistry = None):
+        """
+        :param address: The (host, port) to listen on, or the path of a unix socket.
+        :param pool: The client pool running the jobs. A new one is created if None.
+        :param metrics: The registry served by /metrics. It should be an observer of the pool's clients.
+                        When the pool is created here, it is registered on it, or created if None.
+        """
+        if pool is None:
+            if metrics is None:
+                metrics = MetricsRegistry()
+            pool = AppStoreConnectClientPool(observers=[metrics])
+        self.pool = pool
+        self.metrics = metrics
+        self.unix_socket = isinstance(address, str)
+        if self.unix_socket:
+            self.address_family = socket.AF_UNIX
+            if os.path.exists(address):
+                os.unlink(address)
+        self.__thread = None
+        super().__init__(address, _AppStoreConnectServiceRequestHandler)
+
+    def server_bind(self):
+        if not self.unix_socket:
+            super().server_bind()
+            return
+        # the socket is bound in a private directory and moved into place once only its owner can access it
+        directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.server_address)))
+        try:
+            path = os.path.join(directory, "socket")
+            self.socket.bind(path)
+            os.chmod(path, 0o600)
+            os.rename(path, self.server_address)
+        finally:
+            os.rmdir(directory)
+        self.server_address = self.socket.getsockname()
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def start(self):
+        """
+        Serves requests on a daemon thread.
+        """
+        self.__thread = threading.Thread(target=self.serve_forever, name="AppStoreConnectService", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def server_close(self):
+        super().server_close()
+        if self.unix_socket and os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        self.pool.close()
+
+
+class _AppStoreConnectServiceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: AppStoreConnectService
+
+    def setup(self):
+        super().setup()
+        if not self.server.unix_socket:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def address_string(self):
+        return "unix" if self.server.unix_socket else super().address_string()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def __send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_json(self, status: int, document: dict):
+        self.__send(status, json.dumps(document).encode())
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self.__send_json(200, {"status": "ok", "accounts": [list(key) for key in self.server.pool.accounts()]})
+        elif path == "/metrics" and self.server.metrics is not None:
+            self.__send(200, self.server.metrics.render().encode(), "text/plain; version=0.0.4")
+        else:
+            self.__send_json(404, {"error": f"unknown path {path}"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = self.rfile.read(length) if length else b""
+            params = json.loads(body) if body else {}
+            operation = path[len("/v1/"):] if path.startswith("/v1/") else None
+            if operation not in OPERATIONS:
+                self.__send_json(404, {"error": f"unknown operation {path}"})
+                return
+            credentials = params.pop("keyId"), params.pop("issuerId"), params.pop("p8FilePath")
+            authorization = self.headers.get("Authorization") or ""
+            self.server.pool.authorize(*credentials, authorization[len("Bearer "):] or None, body)
+            future = self.server.pool.submit(*credentials, operation, params)
+            result = future.result()
+        except PermissionError as e:
+            self.__send_json(401, {"error": str(e)})
+            return
+        except (KeyError, TypeError, ValueError) as e:
+            self.__send_json(400, {"error": f"invalid request: {e!r}"})
+            return
+        except Exception as e:
+            logger.exception("%s failed", path)
+            self.__send_json(500, {"error": repr(e)})
+            return
+        if result is None:
+            self.__send_json(502, {"result": None, "error": "App Store Connect API request failed"})
+        else:
+            self.__send_json(200, {"result": result})
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class AppStoreConnectServiceClient:
+    """
+    AppStoreConnectServiceClient class sends jobs to an AppStoreConnectService over one kept-alive connection.
+    Every job is signed with the API key by sign_request_proof, so the caller must be able to read the key file.
+    An instance must not be shared between threads.
+
+    Methods:
+        __init__(self, address: str, keyId: str, issuerId: str, p8FilePath: str, timeout: float = None)
+        call(self, operation: str, **params)
+        close(self)
+
+    Example usage:
+        client = AppStoreConnectServiceClient("http://127.0.0.1:8787", keyId, issuerId, p8FilePath)
+        client.call("profiles/refresh", profile_names=["MyProfile"])"""
+
+    def __init__(self, address: str, keyId: str, issuerId: str, p8FilePath: str, timeout: float = None):
+        """
+        :param address: The URL of a TCP service, e.g. "http://127.0.0.1:8787", or the path of a unix socket.
+        :param p8FilePath: Path to the .p8 private key file, as seen by the service. It is read once to sign the jobs.
+        :param timeout: Socket timeout in seconds. None waits until the job has finished.
+        :raises OSError: If the key file can not be read.
+        """
+        if address.startswith("http://"):
+            url = urlparse(address)
+            self.__connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+        else:
+            self.__connection = _UnixHTTPConnection(address, timeout)
+        self.__credentials = {"keyId": keyId, "issuerId": issuerId, "p8FilePath": os.path.abspath(p8FilePath)}
+        with open(p8FilePath, "rb") as file:
+            self.__private_key = JsonWebKey.import_key(file.read(), {"kty": "EC"})
+
+    def call(self, operation: str, **params):
+        """
+        Runs an operation on the service and waits for its result.
+
+        :param operation: One of OPERATIONS, e.g. "devices/list".
+        :param params: The parameters of the operation, e.g. name_pattern="Dev *".
+        :return: The result of the operation, or None if its API calls failed.
+        :raises RuntimeError: If the service rejected the job.
+        """
+        document = dict(params)
+        document.update(self.__credentials)
+        body = json.dumps(document).encode()
+        proof = sign_request_proof(self.__private_key, self.__credentials["keyId"], self.__credentials["issuerId"],
+                                   body)
+        self.__connection.request("POST", f"/v1/{operation}", body,
+                                  {"Content-Type": "application/json", "Authorization": f"Bearer {proof}"})
+        response = self.__connection.getresponse()
+        document = json.loads(response.read())
+        if response.status not in (200, 502):
+            raise RuntimeError(f"{operation} failed with {response.status}: {document.get('error')}")
+        return document["result"]
+
+    def close(self):
+        self.__connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="keeps warm App Store Connect clients and runs jobs for them")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--socket", type=str, default=None, help="listen on this unix socket instead of TCP")
+    parser.add_argument("--jobs", type=int, default=4, help="number of jobs run concurrently per API key")
+    parser.add_argument("--cacheDir", type=str, default=None, help="directory of the per API key sqlite caches")
+    parser.add_argument("--cacheTtl", type=float, default=600.0, help="seconds the cached devices and profiles are used")
+    parser.add_argument("--journalDir", type=str, default=None,
+                        help="directory of the per API key profile refresh journals, "
+                             "defaults to ~/.app_store_connect/profile_journal")
+    parser.add_argument("--keyRoot", type=str, default=None, help="directory the .p8 key files must be in")
+    parser.add_argument("--outputRoot", type=str, default=None,
+                        help="directory profiles/download writes to; downloads are rejected without it")
+    parser.add_argument("--logRequests", action="store_true", help="log every API request as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    metrics = MetricsRegistry()
+    observers = [metrics] + ([LoggingSink()] if args.logRequests else [])
+    pool = AppStoreConnectClientPool(args.jobs, args.cacheDir, args.cacheTtl, observers=observers,
+                                     key_root=args.keyRoot, output_root=args.outputRoot, journal_dir=args.journalDir)
+    service = AppStoreConnectService(args.socket or (args.host, args.port), pool, metrics)
+    logger.info("serving on %s", args.socket or f"http://{args.host}:{args.port}")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        service.server_close()
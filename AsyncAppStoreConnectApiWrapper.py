@@ -0,0 +1,205 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from AppStoreConnectApiWrapper import AppStoreConnectApiWrapper, AppStoreConnectTokenManager
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAppStoreConnectApiWrapper:
+    """
+    AsyncAppStoreConnectApiWrapper class provides the same methods as AppStoreConnectApiWrapper as coroutines.
+
+    Every request is executed by a pooled AppStoreConnectApiWrapper on a bounded thread pool, so the token cache,
+    the keep-alive connections and the response handling are shared with the sync class. Workflows that need
+    several independent requests send them concurrently.
+
+    Methods:
+        __init__(self, keyId: str, issuerId: str, p8FilePath: str, token_manager: AppStoreConnectTokenManager = None,
+                 max_concurrency: int = 8, **wrapper_options)
+        gather(self, *aws, limit: int = None)
+        get_device_list(self, fields: dict = None)
+        get_profile_list(self, filter_name: str = None, fields: dict = None)
+        get_devices(self, fields: dict = None)
+        get_profiles(self, name: str = None, profile_type: str = None, state: str = None, fields: dict = None)
+        get_profile_by_name(self, profile_name: str, fields: dict = None)
+        find_profiles(self, name: str = None, profile_type: str = None, state: str = None, bundle_id: str = None,
+                      bundle_identifier: str = None, profiles=None, fields: dict = None)
+        get_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_certificates_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_bundle_id_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_devices_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None)
+        get_profile_with_relationships(self, provisioning_profile_id: str, fields: dict = None)
+        register_device(self, deviceName: str, deviceUdid: str, devicePlatform: str)
+        register_devices(self, devices, max_workers: int = 4, dry_run: bool = False)
+        delete_profile(self, provisioning_profile_id: str)
+        create_profile(self, name: str, profile_type: str, bundle_id: str, device_ids: list, certificate_ids: list)
+        duplicate_provisioning_profile(self, provisioning_profile_id: str, duplicate_name: str,
+                                       profile_graph: dict = None)
+        update_provisioning_profile_all_devices(self, provisioning_profile_name: str)
+        update_provisioning_profiles_all_devices(self, profile_names: list = None, name_pattern: str = None,
+                                                 max_workers: int = 4, force: bool = False)
+        download_profiles(self, output_dir: str, name: str = None, profile_type: str = None, bundle_id: str = None,
+                          bundle_identifier: str = None, name_pattern: str = None, max_workers: int = 4)
+        aclose(self)
+
+    Example usage:
+        async with AsyncAppStoreConnectApiWrapper(keyId, issuerId, p8FilePath) as api:
+            devices, profiles = await api.gather(api.get_device_list(), api.get_profile_list())"""
+
+    def __init__(self, keyId: str, issuerId: str, p8FilePath: str, token_manager: AppStoreConnectTokenManager = None,
+                 max_concurrency: int = 8, **wrapper_options):
+        """
+        :param keyId: The key id of the App Store Connect API key.
+        :param issuerId: The issuer id of the App Store Connect API key.
+        :param p8FilePath: Path to the .p8 private key file.
+        :param token_manager: An existing token manager to share with other clients.
+        :param max_concurrency: Maximum number of requests in flight at the same time.
+        :param wrapper_options: Extra keyword arguments passed to AppStoreConnectApiWrapper, e.g. timeout or session.
+        """
+        wrapper_options.setdefault("pool_maxsize", max_concurrency)
+        self.__api = AppStoreConnectApiWrapper(keyId, issuerId, p8FilePath, token_manager=token_manager,
+                                               **wrapper_options)
+        self.__max_concurrency = max_concurrency
+        self.__executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                             thread_name_prefix="AsyncAppStoreConnectApiWrapper")
+
+    @property
+    def sync_api(self) -> AppStoreConnectApiWrapper:
+        return self.__api
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Waits for the running requests and releases the thread pool and the pooled connections.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(self.__executor.shutdown, wait=True))
+        self.__api.close()
+
+    async def __call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        # the context is copied so the requests keep the span of the calling task
+        return await loop.run_in_executor(self.__executor, contextvars.copy_context().run,
+                                          functools.partial(method, *args))
+
+    async def gather(self, *aws, limit: int = None):
+        """
+        Runs the awaitables concurrently, with at most `limit` of them running at the same time.
+
+        :param aws: Coroutines or other awaitables.
+        :param limit: Maximum number of concurrently running awaitables. Defaults to max_concurrency.
+        :return: The results in the same order as aws.
+        """
+        semaphore = asyncio.Semaphore(limit or self.__max_concurrency)
+
+        async def run(aw):
+            async with semaphore:
+                return await aw
+
+        return list(await asyncio.gather(*(run(aw) for aw in aws)))
+
+    async def get_device_list(self, fields: dict = None):
+        return await self.__call(self.__api.get_device_list, fields)
+
+    async def get_profile_list(self, filter_name: str = None, fields: dict = None):
+        return await self.__call(self.__api.get_profile_list, filter_name, fields)
+
+    async def get_devices(self, fields: dict = None):
+        return await self.__call(self.__api.get_devices, fields)
+
+    async def get_profiles(self, name: str = None, profile_type: str = None, state: str = None,
+                           fields: dict = None):
+        return await self.__call(self.__api.get_profiles, name, profile_type, state, fields)
+
+    async def get_profile_by_name(self, profile_name: str, fields: dict = None):
+        return await self.__call(self.__api.get_profile_by_name, profile_name, fields)
+
+    async def find_profiles(self, name: str = None, profile_type: str = None, state: str = None,
+                            bundle_id: str = None, bundle_identifier: str = None, profiles=None,
+                            fields: dict = None):
+        return await self.__call(self.__api.find_profiles, name, profile_type, state, bundle_id, bundle_identifier,
+                                 profiles, fields)
+
+    async def get_profile(self, provisioning_profile_id: str, fields: dict = None):
+        return await self.__call(self.__api.get_profile, provisioning_profile_id, fields)
+
+    async def get_certificates_of_related_provisioning_profile(self, provisioning_profile_id: str,
+                                                               fields: dict = None):
+        return await self.__call(self.__api.get_certificates_of_related_provisioning_profile,
+                                 provisioning_profile_id, fields)
+
+    async def get_bundle_id_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None):
+        return await self.__call(self.__api.get_bundle_id_of_related_provisioning_profile, provisioning_profile_id,
+                                 fields)
+
+    async def get_devices_of_related_provisioning_profile(self, provisioning_profile_id: str, fields: dict = None):
+        return await self.__call(self.__api.get_devices_of_related_provisioning_profile, provisioning_profile_id,
+                                 fields)
+
+    async def register_device(self, deviceName: str, deviceUdid: str, devicePlatform: str):
+        return await self.__call(self.__api.register_device, deviceName, deviceUdid, devicePlatform)
+
+    async def register_devices(self, devices, max_workers: int = 4, dry_run: bool = False):
+        return await self.__call(self.__api.register_devices, devices, max_workers, dry_run)
+
+    async def delete_profile(self, provisioning_profile_id: str):
+        return await self.__call(self.__api.delete_profile, provisioning_profile_id)
+
+    async def create_profile(self, name: str, profile_type: str, bundle_id: str, device_ids: list,
+                             certificate_ids: list):
+        return await self.__call(self.__api.create_profile, name, profile_type, bundle_id, device_ids,
+                                 certificate_ids)
+
+    async def get_profile_with_relationships(self, provisioning_profile_id: str, fields: dict = None):
+        return await self.__call(self.__api.get_profile_with_relationships, provisioning_profile_id, fields)
+
+    async def duplicate_provisioning_profile(self, provisioning_profile_id: str, duplicate_name: str,
+                                             profile_graph: dict = None):
+        return await self.__call(self.__api.duplicate_provisioning_profile, provisioning_profile_id,
+                                 duplicate_name, profile_graph)
+
+    async def update_provisioning_profile_all_devices(self, provisioning_profile_name: str):
+        """
+        Same as AppStoreConnectApiWrapper.update_provisioning_profile_all_devices, but the profile and the list of
+        all devices are fetched concurrently before the refresh planner of the wrapper applies the refresh.
+
+        :return: The result of updating the provisioning profile with all devices. Returns None if there was an error.
+        """
+        with self.__api.span("update_provisioning_profile_all_devices"):
+            return await self.__update_provisioning_profile_all_devices(provisioning_profile_name)
+
+    async def __update_provisioning_profile_all_devices(self, provisioning_profile_name: str):
+        planner = self.__api.refresh_planner
+        profiles, device_ids = await self.gather(
+            self.find_profiles(name=provisioning_profile_name,
+                               fields=AppStoreConnectApiWrapper.PROFILE_METADATA_FIELDS),
+            self.__call(planner.enabled_device_ids))
+        if not profiles or device_ids is None:
+            if profiles == []:
+                logger.warning("provisioning profile not found")
+            return None
+
+        plan = await self.__call(planner.plan, provisioning_profile_name, device_ids, True, profiles[-1])
+        if plan is None:
+            return None
+        return await self.__call(planner.apply, plan)
+
+    async def update_provisioning_profiles_all_devices(self, profile_names: list = None, name_pattern: str = None,
+                                                       max_workers: int = 4, force: bool = False):
+        return await self.__call(self.__api.update_provisioning_profiles_all_devices, profile_names, name_pattern,
+                                 max_workers, force)
+
+    async def download_profiles(self, output_dir: str, name: str = None, profile_type: str = None,
+                                bundle_id: str = None, bundle_identifier: str = None, name_pattern: str = None,
+                                max_workers: int = 4):
+        return await self.__call(self.__api.download_profiles, output_dir, name, profile_type, bundle_id,
+                                 bundle_identifier, name_pattern, max_workers)
@@ -0,0 +1,442 @@
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+class FakeAppStoreConnectStore:
+    """
+    FakeAppStoreConnectStore class holds the devices, profiles, certificates and bundle IDs served by
+    FakeAppStoreConnectServer. Every method is thread safe.
+
+    Methods:
+        __init__(self)
+        seed(self, devices: int = 100, profiles: int = 10, certificates: int = 2, bundle_ids: int = 2,
+             profile_devices: int = None, profile_content_size: int = 12000)
+        snapshot(self) -> dict"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.resources = {"devices": {}, "profiles": {}, "certificates": {}, "bundleIds": {}}
+        self.relationships = {}
+        self.__next_id = 0
+
+    def new_id(self, prefix: str) -> str:
+        with self.lock:
+            self.__next_id += 1
+            return f"{prefix}{self.__next_id:08d}"
+
+    def seed(self, devices: int = 100, profiles: int = 10, certificates: int = 2, bundle_ids: int = 2,
+             profile_devices: int = None, profile_content_size: int = 12000):
+        """
+        Replaces the stored resources with generated ones. The result only depends on the arguments.
+
+        :param devices: Number of registered devices.
+        :param profiles: Number of profiles. The first one is named "Benchmark Profile", the others "Profile <n>".
+        :param certificates: Number of development certificates.
+        :param bundle_ids: Number of bundle IDs.
+        :param profile_devices: Number of devices in each profile. Defaults to every device except the last one,
+                                so that updating a profile with all devices has work to do.
+        :param profile_content_size: Size in bytes of the generated profile content.
+        """
+        generator = random.Random(0)
+        with self.lock:
+            for resources in self.resources.values():
+                resources.clear()
+            self.relationships.clear()
+            self.__next_id = 0
+            for index in range(devices):
+                device_id = self.new_id("D")
+                self.resources["devices"][device_id] = {
+                    "type": "devices", "id": device_id,
+                    "attributes": {"name": f"Device {index}", "udid": f"{generator.getrandbits(160):040x}",
+                                   "platform": "IOS", "status": "ENABLED", "deviceClass": "IPHONE",
+                                   "model": "iPhone 15", "addedDate": "2024-01-01T00:00:00.000+0000"}}
+            for index in range(certificates):
+                certificate_id = self.new_id("C")
+                self.resources["certificates"][certificate_id] = {
+                    "type": "certificates", "id": certificate_id,
+                    "attributes": {"name": f"Certificate {index}", "displayName": f"Developer {index}",
+                                   "certificateType": "DEVELOPMENT", "platform": "IOS",
+                                   "serialNumber": f"{generator.getrandbits(64):016X}",
+                                   "expirationDate": "2030-01-01T00:00:00.000+0000",
+                                   "certificateContent": base64.b64encode(generator.randbytes(1200)).decode()}}
+            for index in range(bundle_ids):
+                bundle_id = self.new_id("B")
+                self.resources["bundleIds"][bundle_id] = {
+                    "type": "bundleIds", "id": bundle_id,
+                    "attributes": {"name": f"App {index}", "identifier": f"com.example.app{index}",
+                                   "platform": "IOS", "seedId": "TEAMID1234"}}
+            device_ids = list(self.resources["devices"])
+            certificate_ids = list(self.resources["certificates"])
+            bundle_id_list = list(self.resources["bundleIds"])
+            included_devices = max(len(device_ids) - 1, 0) if profile_devices is None else profile_devices
+            for index in range(profiles):
+                name = "Benchmark Profile" if index == 0 else f"Profile {index}"
+                self.create_profile(name, "IOS_APP_DEVELOPMENT",
+                                    bundle_id_list[index % len(bundle_id_list)] if bundle_id_list else None,
+                                    certificate_ids, device_ids[:included_devices],
+                                    generator.randbytes(profile_content_size))
+
+    def create_profile(self, name: str, profile_type: str, bundle_id: str, certificate_ids: list, device_ids: list,
+                       content: bytes = None) -> dict:
+        with self.lock:
+            profile_id = self.new_id("P")
+            content = content if content is not None else os.urandom(12000)
+            profile = {
+                "type": "profiles", "id": profile_id,
+                "attributes": {"name": name, "profileType": profile_type, "profileState": "ACTIVE",
+                               "platform": "IOS", "uuid": f"{random.getrandbits(128):032x}",
+                               "createdDate": "2024-01-01T00:00:00.000+0000",
+                               "expirationDate": "2025-01-01T00:00:00.000+0000",
+                               "profileContent": base64.b64encode(content).decode()}}
+            self.resources["profiles"][profile_id] = profile
+            self.relationships[profile_id] = {"bundleId": bundle_id, "certificates": list(certificate_ids),
+                                              "devices": list(device_ids)}
+            return profile
+
+    def snapshot(self) -> dict:
+        """
+        :return: The number of stored resources per type.
+        """
+        with self.lock:
+            return {resource_type: len(resources) for resource_type, resources in self.resources.items()}
+
+
+class FakeAppStoreConnectServer(ThreadingHTTPServer):
+    """
+    FakeAppStoreConnectServer class is a local stand-in for the App Store Connect API, used to measure and
+    regression-test the wrapper without reaching Apple.
+
+    It serves the devices, profiles, certificates and bundleIds endpoints used by AppStoreConnectApiWrapper,
+    with cursor pagination, include, filter[...] and fields[...] parameters, X-Rate-Limit headers, 429 responses
+    when the hourly limit is exhausted or injected at random, and configurable latency and jitter.
+
+    Attributes:
+        DEFAULT_PAGE_SIZE: int - Page size used when the request has no limit parameter.
+        MAX_PAGE_SIZE: int - Largest accepted limit parameter.
+
+    Methods:
+        __init__(self, address: tuple = ("127.0.0.1", 0), store: FakeAppStoreConnectStore = None,
+                 latency: float = 0.0, jitter: float = 0.0, hourly_limit: int = 3600, error_rate: float = 0.0)
+        base_url(self) -> str
+        start(self)
+        stop(self)
+        stats(self) -> dict
+        reset_stats(self)
+
+    Example usage:
+        server = FakeAppStoreConnectServer(latency=0.05)
+        server.store.seed(devices=1000)
+        server.start()
+        api = AppStoreConnectApiWrapper(keyId, issuerId, p8FilePath, base_url=server.base_url())"""
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 200
+    daemon_threads = True
+
+    def __init__(self, address: tuple = ("127.0.0.1", 0), store: FakeAppStoreConnectStore = None,
+                 latency: float = 0.0, jitter: float = 0.0, hourly_limit: int = 3600, error_rate: float = 0.0):
+        """
+        :param address: The (host, port) to listen on. Port 0 picks a free port.
+        :param store: The resources to serve. An empty store is created if None.
+        :param latency: Seconds added to every response.
+        :param jitter: Up to this many seconds are added at random to the latency.
+        :param hourly_limit: Requests accepted per sliding hour before answering 429.
+        :param error_rate: Probability of answering a request with an injected 429.
+        """
+        super().__init__(address, _FakeAppStoreConnectRequestHandler)
+        self.store = store if store is not None else FakeAppStoreConnectStore()
+        self.latency = latency
+        self.jitter = jitter
+        self.hourly_limit = hourly_limit
+        self.error_rate = error_rate
+        self.__stats_lock = threading.Lock()
+        self.__request_times = deque()
+        self.__requests = {}
+        self.__thread = None
+
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serves requests on a daemon thread.
+        """
+        self.__thread = threading.Thread(target=self.serve_forever, name="FakeAppStoreConnectServer", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def admit(self, method: str, path: str):
+        """
+        Records a request and decides whether it is rate limited.
+
+        :return: A tuple of the remaining hourly quota and whether the request must be answered with 429.
+        """
+        now = time.monotonic()
+        endpoint = f"{method} {re.sub(r'/[A-Z][0-9]{8}', '/{id}', path)}"
+        with self.__stats_lock:
+            while self.__request_times and now - self.__request_times[0] > 3600.0:
+                self.__request_times.popleft()
+            self.__requests[endpoint] = self.__requests.get(endpoint, 0) + 1
+            limited = len(self.__request_times) >= self.hourly_limit or random.random() < self.error_rate
+            if not limited:
+                self.__request_times.append(now)
+            return self.hourly_limit - len(self.__request_times), limited
+
+    def stats(self) -> dict:
+        """
+        :return: The number of received requests, in total and per endpoint, like
+                 {"requests": 3, "endpoints": {"GET /v1/profiles/{id}": 1, ...}}.
+        """
+        with self.__stats_lock:
+            return {"requests": sum(self.__requests.values()), "endpoints": dict(self.__requests)}
+
+    def reset_stats(self):
+        with self.__stats_lock:
+            self.__requests.clear()
+            self.__request_times.clear()
+
+
+class _FakeAppStoreConnectRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeAppStoreConnectServer
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, so Nagle's algorithm would delay every response
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.__handle("GET")
+
+    def do_POST(self):
+        self.__handle("POST")
+
+    def do_DELETE(self):
+        self.__handle("DELETE")
+
+    def __send(self, status: int, document: dict = None, headers: dict = None):
+        body = json.dumps(document).encode() if document is not None else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def __error(status: int, detail: str) -> tuple:
+        return status, {"errors": [{"status": str(status), "code": "ERROR", "title": detail, "detail": detail}]}
+
+    def __handle(self, method: str):
+        server = self.server
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        delay = server.latency + random.uniform(0.0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        remaining, limited = server.admit(method, url.path)
+        headers = {"X-Rate-Limit": f"user-hour-lim:{server.hourly_limit};user-hour-rem:{max(remaining, 0)};"}
+        if limited:
+            headers["Retry-After"] = "1"
+            self.__send(*self.__error(429, "The request rate limit has been reached."), headers=headers)
+            return
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self.__send(*self.__error(401, "Authentication credentials are missing or invalid."), headers=headers)
+            return
+
+        try:
+            with server.store.lock:
+                status, document = self.__route(method, url.path, query, body)
+        except (KeyError, TypeError, ValueError) as e:
+            status, document = self.__error(400, f"invalid request: {e!r}")
+        self.__send(status, document, headers)
+
+    def __route(self, method: str, path: str, query: dict, body: dict) -> tuple:
+        store = self.server.store
+        parts = path.strip("/").split("/")
+        if len(parts) < 2 or parts[0] != "v1" or parts[1] not in store.resources:
+            return self.__error(404, "The specified resource does not exist.")
+        resource_type = parts[1]
+        resources = store.resources[resource_type]
+
+        if len(parts) == 2:
+            if method == "GET":
+                return 200, self.__collection(path, query, resource_type, list(resources.values()))
+            if method == "POST" and resource_type == "devices":
+                return self.__create_device(body)
+            if method == "POST" and resource_type == "profiles":
+                return self.__create_profile(body)
+        elif len(parts) in (3, 4):
+            resource = resources.get(parts[2])
+            if resource is None:
+                return self.__error(404, "The specified resource does not exist.")
+            if len(parts) == 3 and method == "GET":
+                return 200, self.__single(resource, query)
+            if len(parts) == 3 and method == "DELETE" and resource_type == "profiles":
+                del resources[parts[2]]
+                del store.relationships[parts[2]]
+                return 204, None
+            if len(parts) == 4 and method == "GET":
+                return self.__related(path, query, resource_type, parts[2], parts[3])
+        return self.__error(405, "The method is not allowed.")
+
+    def __resource(self, resource: dict, query: dict, included_relationships: tuple = ()) -> dict:
+        resource_type = resource["type"]
+        fields = query.get(f"fields[{resource_type}]")
+        selected = None if fields is None else set(fields.split(","))
+        attributes = {name: value for name, value in resource["attributes"].items()
+                      if selected is None or name in selected}
+        result = {"type": resource_type, "id": resource["id"], "attributes": attributes,
+                  "links": {"self": f"{self.server.base_url()}/v1/{resource_type}/{resource['id']}"}}
+        if resource_type == "profiles":
+            relationships = {}
+            related = self.server.store.relationships[resource["id"]]
+            for name in ("bundleId", "certificates", "devices"):
+                if selected is not None and name not in selected:
+                    continue
+                relationship = {"links": {
+                    "related": f"{self.server.base_url()}/v1/profiles/{resource['id']}/{name}"}}
+                if name in included_relationships:
+                    if name == "bundleId":
+                        relationship["data"] = {"type": "bundleIds", "id": related["bundleId"]}
+                    else:
+                        limit = int(query.get(f"limit[{name}]", 50))
+                        relationship["data"] = [{"type": name, "id": item} for item in related[name][:limit]]
+                        relationship["meta"] = {"paging": {"total": len(related[name]), "limit": limit}}
+                relationships[name] = relationship
+            result["relationships"] = relationships
+        return result
+
+    def __single(self, resource: dict, query: dict) -> dict:
+        include = tuple(name for name in query.get("include", "").split(",") if name)
+        document = {"data": self.__resource(resource, query, include),
+                    "links": {"self": f"{self.server.base_url()}{self.path}"}}
+        if include and resource["type"] == "profiles":
+            store = self.server.store
+            related = store.relationships[resource["id"]]
+            included = []
+            if "bundleId" in include and related["bundleId"] in store.resources["bundleIds"]:
+                included.append(self.__resource(store.resources["bundleIds"][related["bundleId"]], query))
+            for name in ("certificates", "devices"):
+                if name in include:
+                    limit = int(query.get(f"limit[{name}]", 50))
+                    included.extend(self.__resource(store.resources[name][item], query)
+                                    for item in related[name][:limit] if item in store.resources[name])
+            document["included"] = included
+        return document
+
+    def __collection(self, path: str, query: dict, resource_type: str, resources: list) -> dict:
+        for name, value in query.items():
+            match = re.fullmatch(r"filter\[(\w+)]", name)
+            if match is None:
+                continue
+            accepted = set(value.split(","))
+            key = match.group(1)
+            resources = [resource for resource in resources
+                         if (resource["id"] if key == "id" else resource["attributes"].get(key)) in accepted]
+
+        limit = min(int(query.get("limit", self.server.DEFAULT_PAGE_SIZE)), self.server.MAX_PAGE_SIZE)
+        offset = int(base64.urlsafe_b64decode(query["cursor"]).decode()) if "cursor" in query else 0
+        page = resources[offset:offset + limit]
+        base_url = self.server.base_url()
+        links = {"self": f"{base_url}{self.path}"}
+        if offset + limit < len(resources):
+            next_query = dict(query)
+            next_query["cursor"] = base64.urlsafe_b64encode(str(offset + limit).encode()).decode()
+            links["next"] = f"{base_url}{path}?{urlencode(next_query)}"
+        return {"data": [self.__resource(resource, query) for resource in page], "links": links,
+                "meta": {"paging": {"total": len(resources), "limit": limit}}}
+
+    def __related(self, path: str, query: dict, resource_type: str, resource_id: str, name: str) -> tuple:
+        store = self.server.store
+        if resource_type == "profiles" and name in ("certificates", "devices"):
+            related = [store.resources[name][item] for item in store.relationships[resource_id][name]
+                       if item in store.resources[name]]
+            return 200, self.__collection(path, query, name, related)
+        if resource_type == "profiles" and name == "bundleId":
+            return 200, {"data": self.__resource(
+                store.resources["bundleIds"][store.relationships[resource_id]["bundleId"]], query)}
+        if resource_type == "bundleIds" and name == "profiles":
+            related = [store.resources["profiles"][profile_id]
+                       for profile_id, relationships in store.relationships.items()
+                       if relationships["bundleId"] == resource_id]
+            return 200, self.__collection(path, query, "profiles", related)
+        return self.__error(404, "The specified relationship does not exist.")
+
+    def __create_device(self, body: dict) -> tuple:
+        store = self.server.store
+        attributes = body["data"]["attributes"]
+        udid = attributes["udid"].lower()
+        if any(device["attributes"]["udid"].lower() == udid for device in store.resources["devices"].values()):
+            return self.__error(409, "A device with this UDID is already registered.")
+        device_id = store.new_id("D")
+        device = {"type": "devices", "id": device_id,
+                  "attributes": {"name": attributes["name"], "udid": attributes["udid"],
+                                 "platform": attributes["platform"], "status": "ENABLED", "deviceClass": "IPHONE",
+                                 "model": None, "addedDate": "2024-01-01T00:00:00.000+0000"}}
+        store.resources["devices"][device_id] = device
+        return 201, {"data": self.__resource(device, {})}
+
+    def __create_profile(self, body: dict) -> tuple:
+        store = self.server.store
+        data = body["data"]
+        relationships = data["relationships"]
+        device_ids = [item["id"] for item in relationships["devices"]["data"]]
+        certificate_ids = [item["id"] for item in relationships["certificates"]["data"]]
+        bundle_id = relationships["bundleId"]["data"]["id"]
+        if bundle_id not in store.resources["bundleIds"] \
+                or any(item not in store.resources["devices"] for item in device_ids) \
+                or any(item not in store.resources["certificates"] for item in certificate_ids):
+            return self.__error(409, "A related resource does not exist.")
+        if any(profile["attributes"]["name"] == data["attributes"]["name"]
+               for profile in store.resources["profiles"].values()):
+            return self.__error(409, "Multiple profiles found with the name.")
+        profile = store.create_profile(data["attributes"]["name"], data["attributes"]["profileType"], bundle_id,
+                                       certificate_ids, device_ids)
+        return 201, {"data": self.__resource(profile, {}, ("bundleId", "certificates", "devices"))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local stand-in for the App Store Connect API")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--devices", type=int, default=100, help="number of generated devices")
+    parser.add_argument("--profiles", type=int, default=10, help="number of generated profiles")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added to the latency")
+    parser.add_argument("--hourlyLimit", type=int, default=3600, help="requests per hour before answering 429")
+    parser.add_argument("--errorRate", type=float, default=0.0, help="probability of an injected 429")
+    args = parser.parse_args()
+
+    server = FakeAppStoreConnectServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                                       hourly_limit=args.hourlyLimit, error_rate=args.errorRate)
+    server.store.seed(devices=args.devices, profiles=args.profiles)
+    print(f"serving on {server.base_url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class InventoryCache:
+    """
+    InventoryCache class keeps a local SQLite copy of devices, profiles, certificates and bundle IDs.
+
+    Each resource type has its own sync time. A type is fresh while its last full sync is younger than the TTL.
+    Full syncs only write the rows whose content changed, and single resources can be inserted, updated or
+    removed in between (e.g. after registering a device) so the cache stays fresh without a resync.
+    Lookups by id, name, UDID and bundle identifier use indexes.
+
+    A sync of a sparse fieldset (e.g. the profiles without profileContent) merges the returned fields into the
+    cached rows and records which fields were synced. The type is then only fresh for reads of those fields.
+
+    Attributes:
+        RESOURCE_TYPES: tuple - The resource types that can be cached.
+
+    Methods:
+        __init__(self, path: str, ttl: float = 600.0)
+        is_fresh(self, resource_type: str, fields=None) -> bool
+        replace_all(self, resource_type: str, resources: list, fields=None) -> dict
+        upsert(self, resource: dict, partial: bool = False)
+        delete(self, resource_type: str, resource_id: str)
+        invalidate(self, resource_type: str = None)
+        get(self, resource_type: str, resource_id: str)
+        find_by_name(self, resource_type: str, name: str) -> list
+        find_device_by_udid(self, udid: str)
+        find_bundle_id_by_identifier(self, identifier: str)
+        list(self, resource_type: str) -> list
+        close(self)"""
+    RESOURCE_TYPES = ("devices", "profiles", "certificates", "bundleIds")
+
+    def __init__(self, path: str, ttl: float = 600.0):
+        """
+        :param path: Path to the SQLite database file. ":memory:" keeps the cache in memory.
+        :param ttl: Number of seconds a full sync of a resource type is considered fresh.
+        """
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.executescript("""
+                CREATE TABLE IF NOT EXISTS resources (
+                    type TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    name TEXT,
+                    udid TEXT,
+                    identifier TEXT,
+                    digest TEXT NOT NULL,
+                    json TEXT NOT NULL,
+                    PRIMARY KEY (type, id)
+                );
+                CREATE INDEX IF NOT EXISTS resources_name ON resources (type, name);
+                CREATE INDEX IF NOT EXISTS resources_udid ON resources (udid) WHERE udid IS NOT NULL;
+                CREATE INDEX IF NOT EXISTS resources_identifier ON resources (identifier) WHERE identifier IS NOT NULL;
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    type TEXT PRIMARY KEY,
+                    synced_at REAL NOT NULL,
+                    fields TEXT
+                );
+            """)
+            columns = [row[1] for row in self.__connection.execute("PRAGMA table_info(sync_state)")]
+            if "fields" not in columns:
+                self.__connection.execute("ALTER TABLE sync_state ADD COLUMN fields TEXT")
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def __row(resource: dict) -> tuple:
+        attributes = resource.get("attributes") or {}
+        udid = attributes.get("udid")
+        document = json.dumps(resource, sort_keys=True, separators=(",", ":"))
+        return (resource["type"], resource["id"], attributes.get("name"), udid.lower() if udid else None,
+                attributes.get("identifier"), hashlib.sha1(document.encode()).hexdigest(), document)
+
+    def is_fresh(self, resource_type: str, fields=None) -> bool:
+        """
+        :param resource_type: One of RESOURCE_TYPES.
+        :param fields: The attribute and relationship names the caller reads. None reads every field.
+        :return: True if the resource type was synced less than ttl seconds ago, with at least these fields.
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT synced_at, fields FROM sync_state WHERE type = ?",
+                                            (resource_type,)).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return False
+        return row[1] is None or (fields is not None and set(fields).issubset(json.loads(row[1])))
+
+    @staticmethod
+    def __merge(cached: dict, resource: dict) -> dict:
+        merged = dict(cached)
+        for key, value in resource.items():
+            if key in ("attributes", "relationships") and isinstance(cached.get(key), dict):
+                merged[key] = dict(cached[key], **value)
+            else:
+                merged[key] = value
+        return merged
+
+    def __cached_documents(self, resource_type: str, resource_ids) -> dict:
+        documents = {}
+        for resource_id in resource_ids:
+            row = self.__connection.execute("SELECT json FROM resources WHERE type = ? AND id = ?",
+                                            (resource_type, resource_id)).fetchone()
+            if row is not None:
+                documents[resource_id] = json.loads(row[0])
+        return documents
+
+    def replace_all(self, resource_type: str, resources: list, fields=None) -> dict:
+        """
+        Replaces every cached resource of a type with the result of a full listing and marks the type as fresh.
+        Rows whose content did not change are not rewritten.
+
+        :param resource_type: One of RESOURCE_TYPES.
+        :param resources: Every resource object of the type, as returned by the API.
+        :param fields: The sparse fieldset the resources were listed with, or None if they hold every field.
+                       The fields are merged into the cached rows and the type is only fresh for these fields.
+        :return: The number of rows per change, like {"added": 1, "updated": 0, "removed": 2}.
+        """
+        with self.__lock, self.__connection:
+            if fields is not None:
+                cached = self.__cached_documents(resource_type, (resource["id"] for resource in resources))
+                resources = [self.__merge(cached[resource["id"]], resource) if resource["id"] in cached
+                             else resource for resource in resources]
+            rows = {resource["id"]: self.__row(resource) for resource in resources}
+            digests = dict(self.__connection.execute("SELECT id, digest FROM resources WHERE type = ?",
+                                                     (resource_type,)))
+            changed = [row for resource_id, row in rows.items() if digests.get(resource_id) != row[5]]
+            removed = [(resource_type, resource_id) for resource_id in digests if resource_id not in rows]
+            self.__connection.executemany("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?)", changed)
+            self.__connection.executemany("DELETE FROM resources WHERE type = ? AND id = ?", removed)
+            self.__connection.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                                      (resource_type, time.time(),
+                                       None if fields is None else json.dumps(sorted(fields))))
+        added = sum(1 for row in changed if row[1] not in digests)
+        return {"added": added, "updated": len(changed) - added, "removed": len(removed)}
+
+    def upsert(self, resource: dict, partial: bool = False):
+        """
+        Inserts or updates a single resource without changing the sync time of its type.
+
+        :param partial: True if the resource holds a sparse fieldset. Its fields are merged into the cached row.
+        """
+        with self.__lock, self.__connection:
+            if partial:
+                cached = self.__cached_documents(resource["type"], (resource["id"],))
+                if resource["id"] in cached:
+                    resource = self.__merge(cached[resource["id"]], resource)
+            self.__connection.execute("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      self.__row(resource))
+
+    def delete(self, resource_type: str, resource_id: str):
+        """
+        Removes a single resource without changing the sync time of its type.
+        """
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM resources WHERE type = ? AND id = ?", (resource_type, resource_id))
+
+    def invalidate(self, resource_type: str = None):
+        """
+        Marks a resource type, or every type if None, as stale. The cached rows are kept.
+        """
+        with self.__lock, self.__connection:
+            if resource_type is None:
+                self.__connection.execute("DELETE FROM sync_state")
+            else:
+                self.__connection.execute("DELETE FROM sync_state WHERE type = ?", (resource_type,))
+
+    def __query(self, sql: str, parameters: tuple) -> list:
+        with self.__lock:
+            return [json.loads(row[0]) for row in self.__connection.execute(sql, parameters)]
+
+    def get(self, resource_type: str, resource_id: str):
+        """
+        :return: The cached resource object, or None if it is not cached.
+        """
+        found = self.__query("SELECT json FROM resources WHERE type = ? AND id = ?", (resource_type, resource_id))
+        return found[0] if found else None
+
+    def find_by_name(self, resource_type: str, name: str) -> list:
+        """
+        :return: Every cached resource of the type whose name attribute equals name.
+        """
+        return self.__query("SELECT json FROM resources WHERE type = ? AND name = ?", (resource_type, name))
+
+    def find_device_by_udid(self, udid: str):
+        """
+        :return: The cached device with the UDID, compared case-insensitively, or None.
+        """
+        found = self.__query("SELECT json FROM resources WHERE udid = ? AND type = 'devices'", (udid.lower(),))
+        return found[0] if found else None
+
+    def find_bundle_id_by_identifier(self, identifier: str):
+        """
+        :return: The cached bundle ID resource with the identifier, e.g. "com.example.app", or None.
+        """
+        found = self.__query("SELECT json FROM resources WHERE identifier = ? AND type = 'bundleIds'", (identifier,))
+        return found[0] if found else None
+
+    def list(self, resource_type: str) -> list:
+        """
+        :return: Every cached resource of the type.
+        """
+        return self.__query("SELECT json FROM resources WHERE type = ? ORDER BY rowid", (resource_type,))
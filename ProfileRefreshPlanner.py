@@ -0,0 +1,393 @@
+import contextvars
+import fnmatch
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from AppStoreConnectApiWrapper import AppStoreConnectApiWrapper
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileRefreshPlan:
+    """
+    ProfileRefreshPlan class holds the state of a profile before a refresh and the devices it is refreshed with.
+    It is also the content of the journal, so a refresh can be resumed or rolled back from it. The keyId and
+    issuerId of the account the profile belongs to are recorded with it.
+
+    Attributes:
+        STATES: tuple - "planned" before the first change, "deleted" after the original profile was deleted,
+                        "completed" after the new profile was created, "rolled_back" after a rollback and
+                        "restored" after a rejected creation was undone by creating the original profile again.
+
+    Methods:
+        to_dict(self) -> dict
+        from_dict(document: dict) -> ProfileRefreshPlan
+        added_device_ids(self) -> list
+        removed_device_ids(self) -> list
+        describe(self) -> str"""
+    STATES = ("planned", "deleted", "completed", "rolled_back", "restored")
+    __slots__ = ("profile_name", "profile_id", "profile_type", "bundle_id", "certificate_ids", "original_device_ids",
+                 "target_device_ids", "state", "created_profile_id", "updated_at", "key_id", "issuer_id")
+
+    def __init__(self, profile_name: str, profile_id: str, profile_type: str, bundle_id: str, certificate_ids: list,
+                 original_device_ids: list, target_device_ids: list, state: str = "planned",
+                 created_profile_id: str = None, updated_at: float = None, key_id: str = None,
+                 issuer_id: str = None):
+        self.profile_name = profile_name
+        self.profile_id = profile_id
+        self.profile_type = profile_type
+        self.bundle_id = bundle_id
+        self.certificate_ids = list(certificate_ids)
+        self.original_device_ids = list(original_device_ids)
+        self.target_device_ids = list(target_device_ids)
+        self.state = state
+        self.created_profile_id = created_profile_id
+        self.updated_at = updated_at if updated_at is not None else time.time()
+        self.key_id = key_id
+        self.issuer_id = issuer_id
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, document: dict):
+        return cls(**{name: document.get(name) for name in cls.__slots__})
+
+    def added_device_ids(self) -> list:
+        original = set(self.original_device_ids)
+        return [device_id for device_id in self.target_device_ids if device_id not in original]
+
+    def removed_device_ids(self) -> list:
+        target = set(self.target_device_ids)
+        return [device_id for device_id in self.original_device_ids if device_id not in target]
+
+    def describe(self) -> str:
+        """
+        :return: A one line summary of the changes, e.g.
+                 "MyProfile: delete P1234 and create with 12 devices (+2 -1)".
+        """
+        return f"{self.profile_name}: delete {self.profile_id} and create with {len(self.target_device_ids)} devices " \
+               f"(+{len(self.added_device_ids())} -{len(self.removed_device_ids())})"
+
+    def __repr__(self):
+        return f"ProfileRefreshPlan({self.to_dict()!r})"
+
+
+class ProfileRefreshPlanner:
+    """
+    ProfileRefreshPlanner class refreshes provisioning profiles with the fewest API calls and keeps a local
+    journal instead of a backup profile on App Store Connect.
+
+    A plan reads the profile with its relationships once. Applying it deletes the profile and creates it again
+    with the target devices. Before the first change the original relationships are written to a journal file,
+    and every later step updates it, so an interrupted refresh can be resumed, or rolled back by creating the
+    profile again with its original devices. No second profile with the same bundle ID exists at any time.
+
+    Every account (keyId and issuerId) has its own subdirectory of journal_dir, and plans recorded for another
+    account are never loaded, resumed, rolled back or applied, so profiles with the same name in different
+    accounts do not share a journal.
+
+    It is the only refresh implementation: the refresh methods of AppStoreConnectApiWrapper, of
+    AsyncAppStoreConnectApiWrapper and of AppStoreConnectService delegate to the planner of the wrapper.
+
+    Attributes:
+        DEFAULT_JOURNAL_DIR: str - The journal directory used when none is given, ~/.app_store_connect/profile_journal.
+        PROFILE_FIELDS: dict - Sparse fieldsets reading only the relationships a refresh needs.
+
+    Methods:
+        __init__(self, api: AppStoreConnectApiWrapper, journal_dir: str = None)
+        enabled_device_ids(self)
+        plan(self, profile_name: str, device_ids: list = None, force: bool = False, profile: dict = None)
+        apply(self, plan: ProfileRefreshPlan)
+        resume(self, profile_name: str)
+        rollback(self, profile_name: str)
+        load(self, profile_name: str)
+        pending(self) -> list
+        refresh_all(self, profile_names: list = None, name_pattern: str = None, max_workers: int = 4,
+                    force: bool = False, dry_run: bool = False)
+
+    Example usage:
+        planner = ProfileRefreshPlanner(api)
+        plan = planner.plan("MyProfile")
+        if plan is not None and plan.state == "planned":
+            print(plan.describe())
+            planner.apply(plan)"""
+    DEFAULT_JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".app_store_connect", "profile_journal")
+    PROFILE_FIELDS = {"profiles": ("name", "profileType", "bundleId", "certificates", "devices"),
+                      "bundleIds": ("identifier",),
+                      "certificates": ("serialNumber",),
+                      "devices": ("udid",)}
+
+    def __init__(self, api: AppStoreConnectApiWrapper, journal_dir: str = None):
+        """
+        :param api: The client used for every request.
+        :param journal_dir: Directory of the journal files, one subdirectory per account and one file per profile
+                            name. It is created when the first plan is applied. Defaults to DEFAULT_JOURNAL_DIR.
+        """
+        self.api = api
+        self.journal_dir = journal_dir or self.DEFAULT_JOURNAL_DIR
+        self.key_id = api.token_manager.keyId
+        self.issuer_id = api.token_manager.issuerId
+        self.account_dir = os.path.join(self.journal_dir, self.__file_name(f"{self.key_id}_{self.issuer_id}"))
+
+    @staticmethod
+    def __file_name(name: str) -> str:
+        return name.replace("/", "_").replace(os.sep, "_")
+
+    def __journal_path(self, profile_name: str) -> str:
+        return os.path.join(self.account_dir, self.__file_name(profile_name) + ".refresh.json")
+
+    def __owns(self, plan: ProfileRefreshPlan) -> bool:
+        if (plan.key_id, plan.issuer_id) == (self.key_id, self.issuer_id):
+            return True
+        logger.error("the plan of %s belongs to the account %s/%s, not to %s/%s", plan.profile_name, plan.key_id,
+                     plan.issuer_id, self.key_id, self.issuer_id)
+        return False
+
+    def __record(self, plan: ProfileRefreshPlan, state: str):
+        plan.state = state
+        plan.updated_at = time.time()
+        os.makedirs(self.account_dir, exist_ok=True)
+        AppStoreConnectApiWrapper.write_file_atomically(
+            self.__journal_path(plan.profile_name), json.dumps(plan.to_dict(), indent=2).encode())
+
+    def load(self, profile_name: str):
+        """
+        :return: The journaled plan of the profile, or None if there is no journal or the journaled plan
+                 belongs to another account.
+        :rtype: ProfileRefreshPlan or None
+        """
+        try:
+            with open(self.__journal_path(profile_name), "r") as file:
+                plan = ProfileRefreshPlan.from_dict(json.load(file))
+        except FileNotFoundError:
+            return None
+        return plan if self.__owns(plan) else None
+
+    def pending(self) -> list:
+        """
+        :return: The journaled plans of this account that were started but not completed or rolled back. Plans are
+                 only journaled by apply, so "planned" entries were interrupted before or during the delete.
+        """
+        if not os.path.isdir(self.account_dir):
+            return []
+        plans = []
+        for file_name in sorted(os.listdir(self.account_dir)):
+            if file_name.endswith(".refresh.json"):
+                with open(os.path.join(self.account_dir, file_name), "r") as file:
+                    plan = ProfileRefreshPlan.from_dict(json.load(file))
+                if plan.state in ("planned", "deleted") and self.__owns(plan):
+                    plans.append(plan)
+        return plans
+
+    def enabled_device_ids(self):
+        """
+        :return: The ids of every registered device that is not disabled, or None if an error occurs.
+        """
+        devices = self.api.get_device_list(self.api.DEVICE_METADATA_FIELDS)
+        if devices is None:
+            return None
+        return [device[ "id" ] for device in devices[ "data" ]
+                if device.get("attributes", {}).get("status", "ENABLED") != "DISABLED"]
+
+    def plan(self, profile_name: str, device_ids: list = None, force: bool = False, profile: dict = None):
+        """
+        Reads the current state of a profile and plans its refresh. Nothing is changed and no journal is written.
+
+        :param profile_name: The exact name of the profile.
+        :param device_ids: The devices the profile must contain. Defaults to every enabled device.
+        :param force: Plan a refresh even if the profile already contains every device.
+        :param profile: The profile resource, if the caller already found it by name.
+        :return: A plan in the "planned" state, a plan in the "completed" state if the profile is up to date,
+                 or None if the profile was not found or an error occurs.
+        :rtype: ProfileRefreshPlan or None
+        """
+        if device_ids is None:
+            device_ids = self.enabled_device_ids()
+            if device_ids is None:
+                return None
+        if profile is None:
+            found = self.api.find_profiles(name=profile_name, fields=self.api.PROFILE_METADATA_FIELDS)
+            if not found:
+                if found is not None:
+                    logger.warning("provisioning profile %s not found", profile_name)
+                return None
+            profile = found[ -1 ]
+
+        graph = self.api.get_profile_with_relationships(profile[ "id" ], self.PROFILE_FIELDS)
+        if graph is None:
+            return None
+        original_device_ids = [device[ "id" ] for device in graph[ "devices" ]]
+        plan = ProfileRefreshPlan(profile_name, profile[ "id" ], graph[ "profile" ][ "attributes" ][ "profileType" ],
+                                  graph[ "bundleId" ][ "id" ],
+                                  [certificate[ "id" ] for certificate in graph[ "certificates" ]],
+                                  original_device_ids, device_ids, key_id=self.key_id, issuer_id=self.issuer_id)
+        if not force and set(original_device_ids).issuperset(device_ids):
+            plan.state = "completed"
+        return plan
+
+    def __current_profiles(self, profile_name: str):
+        return self.api.find_profiles(name=profile_name, fields=self.api.PROFILE_METADATA_FIELDS)
+
+    def __create(self, plan: ProfileRefreshPlan, device_ids: list):
+        return self.api.create_profile(plan.profile_name, plan.profile_type, plan.bundle_id, device_ids,
+                                       plan.certificate_ids)
+
+    def apply(self, plan: ProfileRefreshPlan):
+        """
+        Applies a plan: journals it, deletes the profile and creates it again with the target devices.
+        If the creation fails, the profile is created again with its original devices right away and the plan
+        is "restored". Only if that fails too, the journal stays in the "deleted" state for resume or rollback.
+
+        :return: The response JSON of the create profile request, or None if the plan is already completed
+                 or an error occurs.
+        """
+        if plan.state != "planned" or not self.__owns(plan):
+            return None
+        self.__record(plan, "planned")
+        if not self.api.delete_profile(plan.profile_id):
+            return None
+        self.__record(plan, "deleted")
+        created = self.__create(plan, plan.target_device_ids)
+        if created is None:
+            restored = self.__create(plan, plan.original_device_ids)
+            if restored is None:
+                logger.error("%s was deleted and could not be created again, run resume or rollback",
+                             plan.profile_name)
+                return None
+            plan.created_profile_id = restored[ "data" ][ "id" ]
+            self.__record(plan, "restored")
+            logger.warning("%s could not be created with the new devices and was restored with its original devices",
+                           plan.profile_name)
+            return None
+        plan.created_profile_id = created[ "data" ][ "id" ]
+        self.__record(plan, "completed")
+        return created
+
+    def resume(self, profile_name: str):
+        """
+        Finishes an interrupted refresh. The profiles on App Store Connect decide which steps are left,
+        so a step that succeeded before the journal was updated is not repeated.
+
+        :return: The response JSON of the create profile request, or None if nothing was left to do
+                 or an error occurs.
+        """
+        plan = self.load(profile_name)
+        if plan is None or plan.state in ("completed", "rolled_back", "restored"):
+            return None
+        current = self.__current_profiles(profile_name)
+        if current is None:
+            return None
+        current_ids = [profile[ "id" ] for profile in current]
+        created = [profile_id for profile_id in current_ids if profile_id != plan.profile_id]
+        if created:
+            plan.created_profile_id = created[ -1 ]
+            self.__record(plan, "completed")
+            return None
+        if plan.profile_id in current_ids:
+            plan.state = "planned"
+            return self.apply(plan)
+        self.__record(plan, "deleted")
+        result = self.__create(plan, plan.target_device_ids)
+        if result is None:
+            return None
+        plan.created_profile_id = result[ "data" ][ "id" ]
+        self.__record(plan, "completed")
+        return result
+
+    def rollback(self, profile_name: str):
+        """
+        Restores the devices the profile had before the journaled refresh. A refreshed profile is deleted and
+        the profile is created again with its original relationships. The restored profile gets a new id.
+
+        :return: The response JSON of the create profile request, True if the original profile was never deleted,
+                 or None if there is no journal, the profile was already restored or an error occurs.
+        """
+        plan = self.load(profile_name)
+        if plan is None or plan.state in ("rolled_back", "restored"):
+            return None
+        current = self.__current_profiles(profile_name)
+        if current is None:
+            return None
+        current_ids = [profile[ "id" ] for profile in current]
+        if plan.profile_id in current_ids:
+            self.__record(plan, "rolled_back")
+            return True
+        for profile_id in current_ids:
+            if not self.api.delete_profile(profile_id):
+                return None
+        restored = self.__create(plan, plan.original_device_ids)
+        if restored is None:
+            return None
+        plan.created_profile_id = restored[ "data" ][ "id" ]
+        self.__record(plan, "rolled_back")
+        return restored
+
+    def refresh_all(self, profile_names: list = None, name_pattern: str = None, max_workers: int = 4,
+                    force: bool = False, dry_run: bool = False):
+        """
+        Plans and applies the refresh of many profiles with every enabled device. The device list is fetched once
+        and shared by every profile, and only the profiles missing devices are refreshed.
+
+        :param profile_names: Exact names of the profiles to refresh.
+        :param name_pattern: A shell style pattern. Every profile whose name matches is refreshed.
+        :param max_workers: Number of profiles processed concurrently.
+        :param force: Refresh the profiles even if they already contain every device.
+        :param dry_run: Only plan the refreshes.
+        :return: A dict mapping each profile name to a result dict with the keys "status", "plan" and "profile".
+                 status is one of "planned" (dry run), "updated", "up_to_date", "not_found", "restored" (the new
+                 profile was rejected and the original one was created again) or "failed".
+                 None is returned if the devices or profiles could not be retrieved.
+        :rtype: dict or None
+        """
+        profile_names = [] if profile_names is None else profile_names
+        device_ids = self.enabled_device_ids()
+        if device_ids is None:
+            return None
+        results = {name: {"status": "not_found", "plan": None, "profile": None} for name in profile_names}
+        targets = {name: None for name in profile_names}
+        if name_pattern is not None:
+            profiles = self.api.get_profile_list(fields=self.api.PROFILE_METADATA_FIELDS)
+            if profiles is None:
+                return None
+            for profile in profiles[ "data" ]:
+                name = profile[ "attributes" ][ "name" ]
+                if name in results or fnmatch.fnmatchcase(name, name_pattern):
+                    targets[ name ] = profile
+            targets = {name: profile for name, profile in targets.items() if profile is not None}
+
+        def refresh(name: str, profile: dict) -> dict:
+            try:
+                if profile is None:
+                    found = self.api.find_profiles(name=name, fields=self.api.PROFILE_METADATA_FIELDS)
+                    if not found:
+                        return {"status": "not_found" if found is not None else "failed", "plan": None,
+                                "profile": None}
+                    profile = found[ -1 ]
+                plan = self.plan(name, device_ids, force, profile)
+                if plan is None:
+                    return {"status": "failed", "plan": None, "profile": None}
+                if plan.state == "completed":
+                    return {"status": "up_to_date", "plan": plan, "profile": None}
+                if dry_run:
+                    return {"status": "planned", "plan": plan, "profile": None}
+                created = self.apply(plan)
+                if created is None:
+                    return {"status": "restored" if plan.state == "restored" else "failed", "plan": plan,
+                            "profile": None}
+                return {"status": "updated", "plan": plan, "profile": created}
+            except Exception as e:
+                logger.error("%s", e)
+                return {"status": "failed", "plan": None, "profile": None}
+
+        with self.api.span("refresh_profiles"), \
+                ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ProfileRefreshPlanner") as executor:
+            # the workers run in a copy of this context, so their requests belong to the span
+            futures = {name: executor.submit(contextvars.copy_context().run, refresh, name, profile)
+                       for name, profile in targets.items()}
+            for name, future in futures.items():
+                results[ name ] = future.result()
+        return results
@@ -0,0 +1,302 @@
+"""
+Command line interface of the App Store Connect utilities.
+
+    python app_store_connect.py --help
+    python app_store_connect.py update "Development Profile" --keyId KEY_ID --issuerId ISSUER_ID --p8filePath AuthKey.p8
+    python app_store_connect.py batch jobs.jsonl
+
+The wrapper, authlib and requests are only imported once a command needs the API, so --help and argument
+errors return immediately. The batch command runs many commands in one process with shared clients.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+KEY_ID_ENVIRONMENT_VARIABLE = "APP_STORE_CONNECT_KEY_ID"
+ISSUER_ID_ENVIRONMENT_VARIABLE = "APP_STORE_CONNECT_ISSUER_ID"
+P8_FILE_PATH_ENVIRONMENT_VARIABLE = "APP_STORE_CONNECT_P8_FILE_PATH"
+
+
+def add_devices_arguments(parser: argparse.ArgumentParser):
+    pass
+
+
+def run_devices(api, args, out) -> bool:
+    devices = api.get_devices(api.DEVICE_METADATA_FIELDS)
+    if devices is None:
+        out("デバイスリストの取得に失敗")
+        return False
+    for device in devices:
+        out(f"{device.name}\t{device.udid}\t{device.platform}\t{device.status}")
+    return True
+
+
+def add_register_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("firebaseTsvPath",type=str,help="filePath of firebase app distribution udid tsv file")
+    parser.add_argument("--workers", type=int, default=4, help="number of devices registered concurrently")
+    parser.add_argument("--dryRun", action="store_true", help="only show the devices that would be registered")
+
+
+def run_register(api, args, out) -> bool:
+    import csv
+
+    with open(args.firebaseTsvPath) as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        results = api.register_devices(((item["Device Name"], item["Device ID"], "IOS") for item in reader),
+                                       max_workers=args.workers, dry_run=args.dryRun)
+
+    if results is None:
+        out("デバイスリストの取得に失敗")
+        return False
+
+    for result in results:
+        if result["status"] != "already_present":
+            out(f"{result['name']} ({result['udid']}): {result['status']}")
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    out(str(counts))
+    return counts.get("failed", 0) == 0
+
+
+def add_download_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("profileName",type=str,nargs="?",default=None,help="name of profile. every profile matching the filters if omitted")
+    parser.add_argument("outputDir", type=str, help="directory to save")
+    parser.add_argument("--type", type=str, default=None, help="download only profiles of this profileType, e.g. IOS_APP_ADHOC")
+    parser.add_argument("--bundleId", type=str, default=None, help="download only profiles of this bundle identifier")
+    parser.add_argument("--pattern", type=str, default=None, help="download only profiles whose name matches, e.g. 'AdHoc *'")
+    parser.add_argument("--workers", type=int, default=4, help="number of profiles saved concurrently")
+
+
+def run_download(api, args, out) -> bool:
+    results = api.download_profiles(args.outputDir, name=args.profileName, profile_type=args.type,
+                                    bundle_identifier=args.bundleId, name_pattern=args.pattern,
+                                    max_workers=args.workers)
+    if not results:
+        out("profile is None")
+        return False
+
+    for name, status in results.items():
+        out(f"{name}: {status}")
+    return "failed" not in results.values()
+
+
+def add_update_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("profileName", type=str, nargs="*", help="names of target provisioning profiles")
+    parser.add_argument("--pattern", type=str, default=None, help="update every profile whose name matches, e.g. 'Dev *'")
+    parser.add_argument("--workers", type=int, default=4, help="number of profiles updated concurrently")
+    parser.add_argument("--force", action="store_true", help="regenerate profiles that already contain every device")
+    parser.add_argument("--plan", action="store_true", help="only print the changes that would be made")
+    parser.add_argument("--resume", action="store_true", help="finish the refreshes interrupted in the journal")
+    parser.add_argument("--rollback", action="store_true", help="restore the devices the profiles had before the last refresh")
+    parser.add_argument("--journalDir", type=str, default=None,
+                        help="directory of the refresh journals, one per API key. "
+                             "defaults to ~/.app_store_connect/profile_journal")
+
+
+def check_update_arguments(parser: argparse.ArgumentParser, args):
+    if args.rollback and not args.profileName:
+        parser.error("--rollback requires profileName")
+    if not args.profileName and args.pattern is None and not args.resume:
+        parser.error("profileName or --pattern is required")
+
+
+def run_update(api, args, out) -> bool:
+    from ProfileRefreshPlanner import ProfileRefreshPlanner
+
+    planner = ProfileRefreshPlanner(api, args.journalDir)
+    if args.rollback or args.resume:
+        names = args.profileName or [plan.profile_name for plan in planner.pending()]
+        failed = False
+        for name in names:
+            result = planner.rollback(name) if args.rollback else planner.resume(name)
+            plan = planner.load(name)
+            out(f"{name}: {plan.state if plan is not None else 'no journal'}")
+            failed = failed or plan is None or (result is None and plan.state not in ("completed", "rolled_back",
+                                                                                         "restored"))
+        return not failed
+
+    results = planner.refresh_all(args.profileName, args.pattern, args.workers, args.force, dry_run=args.plan)
+    if results is None:
+        out("デバイスリストかProfileリストの取得に失敗")
+        return False
+
+    for name, result in results.items():
+        if result["status"] == "planned":
+            out(result["plan"].describe())
+        elif result["status"] == "restored":
+            out(f"{name}: restored (新しいデバイスでの作成に失敗したため元のデバイスで作り直しました)")
+        else:
+            out(f"{name}: {result['status']}")
+    return not any(result["status"] in ("failed", "not_found", "restored") for result in results.values())
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("manifest", type=str, help="JSONL file, or YAML file with PyYAML installed, listing the commands")
+    parser.add_argument("--jobs", type=int, default=4, help="number of commands run concurrently")
+
+
+COMMANDS = {
+    "devices": (add_devices_arguments, run_devices, "list the registered devices"),
+    "register": (add_register_arguments, run_register, "register the devices of a Firebase App Distribution TSV"),
+    "download": (add_download_arguments, run_download, "download provisioning profiles"),
+    "update": (add_update_arguments, run_update, "add every device to provisioning profiles"),
+    "batch": (add_batch_arguments, None, "run the commands of a manifest in one process")
+}
+CHECKS = {
+    "update": check_update_arguments
+}
+
+
+def add_client_arguments(parser: argparse.ArgumentParser, positional: bool = False):
+    """
+    Adds the credentials and cache options. The credentials default to the APP_STORE_CONNECT_* environment
+    variables, or are positional arguments as in the original scripts if positional is True.
+    """
+    if positional:
+        parser.add_argument("keyId", type=str, help="apple_auth_key_id")
+        parser.add_argument("issuerId", type=str, help="apple_auth_issuer_id")
+        parser.add_argument("p8filePath", type=str, help="apple p8filePath")
+    else:
+        parser.add_argument("--keyId", type=str, default=os.environ.get(KEY_ID_ENVIRONMENT_VARIABLE),
+                            help=f"apple_auth_key_id. defaults to ${KEY_ID_ENVIRONMENT_VARIABLE}")
+        parser.add_argument("--issuerId", type=str, default=os.environ.get(ISSUER_ID_ENVIRONMENT_VARIABLE),
+                            help=f"apple_auth_issuer_id. defaults to ${ISSUER_ID_ENVIRONMENT_VARIABLE}")
+        parser.add_argument("--p8filePath", type=str, default=os.environ.get(P8_FILE_PATH_ENVIRONMENT_VARIABLE),
+                            help=f"apple p8filePath. defaults to ${P8_FILE_PATH_ENVIRONMENT_VARIABLE}")
+    parser.add_argument("--cachePath", type=str, default=None, help="sqlite file to cache devices and profiles between runs")
+    parser.add_argument("--cacheDir", type=str, default=None,
+                        help="directory of one sqlite cache per API key, e.g. for the accounts of a batch manifest")
+    parser.add_argument("--cacheTtl", type=float, default=600.0, help="seconds the cached devices and profiles are used")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="app_store_connect", description="App Store Connect API utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="command")
+    for name, (add_arguments, _, help) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        add_arguments(subparser)
+        add_client_arguments(subparser)
+    return parser
+
+
+def create_pool(args):
+    """
+    Creates the AppStoreConnectService.AppStoreConnectClientPool sharing one client per API key between the
+    commands. --cachePath is the cache of the command line credentials, --cacheDir holds one cache per API key.
+    """
+    from AppStoreConnectService import AppStoreConnectClientPool
+
+    cache_paths = {(args.keyId, args.issuerId): args.cachePath} if args.cachePath else None
+    return AppStoreConnectClientPool(cache_dir=args.cacheDir, cache_ttl=args.cacheTtl, cache_paths=cache_paths)
+
+
+def load_manifest(path: str) -> list:
+    """
+    Reads a manifest. A JSONL manifest has one JSON object per line, a YAML manifest is a list of objects.
+    Every object has a "command" and its "args" as on the command line, and may override "keyId",
+    "issuerId" and "p8filePath":
+
+        {"command": "update", "args": ["Development Profile", "--force"]}
+        {"command": "download", "args": ["AdHoc Profile", "profiles"], "keyId": "OTHER_KEY_ID"}
+    """
+    with open(path, "r") as file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("PyYAML is required to read YAML manifests: pip install pyyaml")
+            entries = yaml.safe_load(file) or []
+        else:
+            entries = [json.loads(line) for line in file if line.strip() and not line.lstrip().startswith("#")]
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise SystemExit(f"{path}: the manifest must be a list of objects")
+    return entries
+
+
+def run_batch(args) -> bool:
+    """
+    Runs every command of the manifest with shared clients and prints one JSON line per command as it finishes.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    jobs = []
+    for index, entry in enumerate(load_manifest(args.manifest)):
+        command = entry.get("command")
+        if command not in COMMANDS or command == "batch":
+            raise SystemExit(f"{args.manifest}: entry {index} has an unknown command {command!r}")
+        parser = argparse.ArgumentParser(prog=f"{args.manifest}[{index}] {command}")
+        COMMANDS[command][0](parser)
+        job_args = parser.parse_args([str(arg) for arg in entry.get("args", [])])
+        if command in CHECKS:
+            CHECKS[command](parser, job_args)
+        credentials = tuple(entry.get(name) or getattr(args, name) for name in ("keyId", "issuerId", "p8filePath"))
+        if not all(credentials):
+            raise SystemExit(f"{args.manifest}: entry {index} has no keyId, issuerId or p8filePath")
+        jobs.append((index, command, job_args, credentials))
+
+    pool = create_pool(args)
+
+    def run(index: int, command: str, job_args, credentials: tuple) -> dict:
+        lines = []
+        started = time.monotonic()
+        try:
+            succeeded = COMMANDS[command][1](pool.get(*credentials), job_args, lines.append)
+        except Exception as e:
+            lines.append(repr(e))
+            succeeded = False
+        return {"index": index, "command": command, "succeeded": succeeded, "output": lines,
+                "elapsed": round(time.monotonic() - started, 3)}
+
+    succeeded = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="AppStoreConnectBatch") as executor:
+            futures = [executor.submit(run, *job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                succeeded += result["succeeded"]
+                print(json.dumps(result, ensure_ascii=False), flush=True)
+    finally:
+        pool.close()
+    print(json.dumps({"succeeded": succeeded, "failed": len(jobs) - succeeded}), flush=True)
+    return succeeded == len(jobs)
+
+
+def run(parser: argparse.ArgumentParser, args) -> int:
+    if args.command in CHECKS:
+        CHECKS[args.command](parser, args)
+    if args.command == "batch":
+        return 0 if run_batch(args) else 1
+    if not (args.keyId and args.issuerId and args.p8filePath):
+        parser.error(f"--keyId, --issuerId and --p8filePath, or ${KEY_ID_ENVIRONMENT_VARIABLE}, "
+                     f"${ISSUER_ID_ENVIRONMENT_VARIABLE} and ${P8_FILE_PATH_ENVIRONMENT_VARIABLE} are required")
+    pool = create_pool(args)
+    try:
+        return 0 if COMMANDS[args.command][1](pool.get(args.keyId, args.issuerId, args.p8filePath), args, print) else 1
+    finally:
+        pool.close()
+
+
+def main(argv: list = None) -> int:
+    parser = build_parser()
+    return run(parser, parser.parse_args(argv))
+
+
+def legacy_main(command: str, argv: list = None) -> int:
+    """
+    Runs a command with the command line of the original scripts, where the credentials are the first
+    positional arguments.
+    """
+    parser = argparse.ArgumentParser()
+    add_client_arguments(parser, positional=True)
+    COMMANDS[command][0](parser)
+    args = parser.parse_args(argv)
+    args.command = command
+    return run(parser, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import argparse
+import csv
+import json
+import os
+import resource
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+from FakeAppStoreConnectServer import FakeAppStoreConnectServer
+
+SCENARIOS = ("get_device_list", "duplicate_provisioning_profile", "update_provisioning_profile_all_devices",
+             "register_device_by_firebase_app_distribution_tsv")
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_key(path: str):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    with open(path, "wb") as file:
+        file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()))
+
+
+def write_tsv(path: str, server: FakeAppStoreConnectServer, size: int):
+    # half of the rows are registered devices, the other half are new ones
+    registered = [device["attributes"] for device in list(server.store.resources["devices"].values())[:size // 2]]
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file, delimiter="\t")
+        writer.writerow(["Device ID", "Device Name", "Device Model Name", "Device Platform"])
+        for attributes in registered:
+            writer.writerow([attributes["udid"].upper(), attributes["name"], "iPhone 15", "ios"])
+        for index in range(size - len(registered)):
+            writer.writerow([f"00008110-{index:016X}", f"New Device {index}", "iPhone 15", "ios"])
+
+
+def percentile(values: list, ratio: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+def run_worker(scenario: str, key_path: str, tsv_path: str):
+    """
+    Runs one scenario in this process and prints its client side measurements as JSON.
+    The loopback base URL of the fake server is read from the environment by AppStoreConnectApiWrapper.
+    """
+    import requests
+
+    latencies = []
+    send = requests.Session.send
+
+    def timed_send(session, request, **kwargs):
+        started = time.perf_counter()
+        try:
+            return send(session, request, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    requests.Session.send = timed_send
+
+    started = time.perf_counter()
+    succeeded = True
+    if scenario == "register_device_by_firebase_app_distribution_tsv":
+        script = os.path.join(SCRIPT_DIR, "register_device_by_firebase_app_distribution_tsv.py")
+        sys.argv = [script, "BENCHMARK_KEY", "BENCHMARK_ISSUER", key_path, tsv_path]
+        try:
+            runpy.run_path(script, run_name="__main__")
+        except SystemExit as e:
+            succeeded = not e.code
+    else:
+        from AppStoreConnectApiWrapper import AppStoreConnectApiWrapper
+
+        # the refresh journal is kept next to the temporary key instead of the home directory
+        with AppStoreConnectApiWrapper("BENCHMARK_KEY", "BENCHMARK_ISSUER", key_path,
+                                       journal_dir=os.path.join(os.path.dirname(key_path), "journal")) as api:
+            if scenario == "get_device_list":
+                succeeded = api.get_device_list() is not None
+            elif scenario == "duplicate_provisioning_profile":
+                profile = api.get_profile_by_name("Benchmark Profile", api.PROFILE_METADATA_FIELDS)
+                succeeded = profile is not None and api.duplicate_provisioning_profile(
+                    profile["id"], "Benchmark Profile Copy") is not None
+            elif scenario == "update_provisioning_profile_all_devices":
+                succeeded = api.update_provisioning_profile_all_devices("Benchmark Profile") is not None
+            else:
+                raise ValueError(f"unknown scenario {scenario}")
+    wall_time = time.perf_counter() - started
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_kb = peak // 1024 if sys.platform == "darwin" else peak
+    print(json.dumps({"succeeded": succeeded, "wall_time": wall_time, "latencies": latencies,
+                      "peak_memory_kb": peak_kb}))
+
+
+def run_benchmark(sizes: list, scenarios: list, latency: float, jitter: float, error_rate: float) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        key_path = os.path.join(directory, "AuthKey_BENCHMARK.p8")
+        tsv_path = os.path.join(directory, "devices.tsv")
+        write_key(key_path)
+        server = FakeAppStoreConnectServer(latency=latency, jitter=jitter, hourly_limit=10 ** 9,
+                                           error_rate=error_rate)
+        server.start()
+        try:
+            env = dict(os.environ)
+            env["APP_STORE_CONNECT_API_BASE_URL"] = server.base_url()
+            for size in sizes:
+                for scenario in scenarios:
+                    server.store.seed(devices=size, profiles=10)
+                    write_tsv(tsv_path, server, size)
+                    server.reset_stats()
+                    completed = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "--worker", scenario, "--keyPath", key_path,
+                         "--tsvPath", tsv_path],
+                        env=env, cwd=SCRIPT_DIR, capture_output=True, text=True, check=True)
+                    measured = json.loads(completed.stdout.strip().splitlines()[-1])
+                    results.append({
+                        "scenario": scenario,
+                        "devices": size,
+                        "succeeded": measured["succeeded"],
+                        "requests": server.stats()["requests"],
+                        "wall_time": measured["wall_time"],
+                        "p50_latency": percentile(measured["latencies"], 0.50),
+                        "p99_latency": percentile(measured["latencies"], 0.99),
+                        "peak_memory_kb": measured["peak_memory_kb"]
+                    })
+        finally:
+            server.stop()
+    return results
+
+
+def run_checks() -> list:
+    """
+    Runs the workflows in this process against a FakeAppStoreConnectServer without latency and compares their
+    results and request counts with the expected ones, so regressions show up without network access.
+
+    :return: A list of (name, passed, detail) tuples.
+    """
+    from AppStoreConnectApiWrapper import AppStoreConnectApiWrapper
+
+    checks = []
+
+    def check(name: str, passed: bool, detail):
+        checks.append((name, bool(passed), detail))
+
+    with tempfile.TemporaryDirectory() as directory:
+        key_path = os.path.join(directory, "AuthKey_CHECK.p8")
+        write_key(key_path)
+        server = FakeAppStoreConnectServer(latency=0.0, jitter=0.0, hourly_limit=10 ** 9)
+        server.start()
+        try:
+            # devices, pages of devices, requests of duplicate_provisioning_profile and of the profile update
+            for size, pages, duplicate_requests, update_requests in ((10, 1, 3, 5), (450, 3, 6, 10)):
+                server.store.seed(devices=size, profiles=10)
+                with AppStoreConnectApiWrapper("CHECK_KEY", "CHECK_ISSUER", key_path, base_url=server.base_url(),
+                                               journal_dir=os.path.join(directory, "journal")) as api:
+                    server.reset_stats()
+                    devices = api.get_device_list()
+                    check(f"get_device_list({size})", devices is not None and len(devices["data"]) == size
+                          and server.stats()["requests"] == pages, server.stats())
+
+                    server.reset_stats()
+                    profile = api.get_profile_by_name("Benchmark Profile", api.PROFILE_METADATA_FIELDS)
+                    copy = api.duplicate_provisioning_profile(profile["id"], "Benchmark Profile Copy")
+                    stats = server.stats()
+                    copied = api.get_devices_of_related_provisioning_profile(copy["data"]["id"])
+                    # the seeded profile holds every device except the last one
+                    check(f"duplicate_provisioning_profile({size})", len(copied["data"]) == size - 1
+                          and stats["requests"] == duplicate_requests, stats)
+
+                    server.store.seed(devices=size, profiles=10)
+                    server.reset_stats()
+                    updated = api.update_provisioning_profile_all_devices("Benchmark Profile")
+                    stats = server.stats()
+                    devices = api.get_devices_of_related_provisioning_profile(updated["data"]["id"])
+                    check(f"update_provisioning_profile_all_devices({size})", len(devices["data"]) == size
+                          and stats["requests"] == update_requests, stats)
+
+                    server.reset_stats()
+                    registered = devices["data"][0]["attributes"]["udid"]
+                    results = api.register_devices([("New 1", "00008110-CHECK0001"), ("New 2", "00008110-CHECK0002"),
+                                                    ("New 1", "00008110-check0001"), ("Known", registered)])
+                    check(f"register_devices({size})", [result["status"] for result in results] == [
+                        "created", "created", "duplicate", "already_present"]
+                          and server.stats()["requests"] == pages + 2, server.stats())
+        finally:
+            server.stop()
+
+        os.environ[AppStoreConnectApiWrapper.BASE_URL_ENVIRONMENT_VARIABLE] = "http://example.com"
+        try:
+            with AppStoreConnectApiWrapper("CHECK_KEY", "CHECK_ISSUER", key_path) as api:
+                check("non loopback base URL override is ignored",
+                      api.ENDPOINT_DEVICES == AppStoreConnectApiWrapper.ENDPOINT_DEVICES, api.ENDPOINT_DEVICES)
+        finally:
+            del os.environ[AppStoreConnectApiWrapper.BASE_URL_ENVIRONMENT_VARIABLE]
+    return checks
+
+
+def print_table(results: list):
+    header = f"{'scenario':<50} {'devices':>7} {'ok':>3} {'requests':>8} {'wall[s]':>8} {'p50[ms]':>8} " \
+             f"{'p99[ms]':>8} {'peak[MB]':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['scenario']:<50} {result['devices']:>7} {'yes' if result['succeeded'] else 'NO':>3} "
+              f"{result['requests']:>8} {result['wall_time']:>8.3f} {result['p50_latency'] * 1000:>8.1f} "
+              f"{result['p99_latency'] * 1000:>8.1f} {result['peak_memory_kb'] / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the workflows against FakeAppStoreConnectServer")
+    parser.add_argument("--sizes", type=str, default="10,100,1000,10000", help="comma separated device counts")
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help="comma separated scenarios")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01, help="random seconds added to the latency")
+    parser.add_argument("--errorRate", type=float, default=0.0, help="probability of an injected 429")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--check", action="store_true",
+                        help="only run the offline regression checks of request counts and pagination")
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--keyPath", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--tsvPath", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        run_worker(args.worker, args.keyPath, args.tsvPath)
+    elif args.check:
+        checks = run_checks()
+        for name, passed, detail in checks:
+            print(f"{'ok' if passed else 'FAILED':<6} {name} {'' if passed else detail}")
+        sys.exit(0 if all(passed for _, passed, _ in checks) else 1)
+    else:
+        results = run_benchmark([int(size) for size in args.sizes.split(",")], args.scenarios.split(","),
+                                args.latency, args.jitter, args.errorRate)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_table(results)